@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+import sys
+import os
+import logging
+from time import monotonic
+import matplotlib
+# never try to open a display, we may be running inside the web server
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from astropy.io import fits
+
+# Add analysis files
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "analysis"))
+import DamicImage
+import PixelDistribution as pd
+import PoissonGausFit as poisgaus
+import ClusterFinder
+import numpy as np
+import configparser
+import multiprocessing
+from threading import RLock
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+log = logging.getLogger(__name__)
+
+# number of poisson terms in the pixel distribution fits
+npoisson = 20
+
+# worker processes for analyzing segments, started on first use
+_pool = None
+_poolworkers = None
+_poollock = RLock()
+
+
+def getpool(workers=None):
+    """ Get the process pool for segment fits, starting it if needed
+    Workers are started by a fork server rather than forked from this
+    process, whose other threads may be holding locks the children would
+    inherit.
+    Args:
+      workers (int): number of processes, default one per cpu
+    """
+    global _pool, _poolworkers
+    with _poollock:
+        if _pool is None or _poolworkers != workers:
+            shutdownpool()
+            _pool = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('forkserver'))
+            _poolworkers = workers
+        return _pool
+
+
+def shutdownpool(wait=False):
+    """ Stop the worker processes, if any. getpool starts new ones """
+    global _pool
+    with _poollock:
+        if _pool is not None:
+            _pool.shutdown(wait=wait)
+            _pool = None
+
+
+def submitsegments(fitsfile, segments, workers=None):
+    """ Start analyzing `segments` of `fitsfile` in the process pool. A pool
+    left broken by a worker that died is replaced first
+    Returns:
+      pending (list): a future of the analyzesegment result of each segment
+    """
+    try:
+        pool = getpool(workers)
+        return [pool.submit(analyzesegment, fitsfile, hdu, columns)
+                for name, hdu, columns in segments]
+    except BrokenProcessPool:
+        log.warning("Segment fit pool broken, restarting it")
+        shutdownpool()
+        pool = getpool(workers)
+        return [pool.submit(analyzesegment, fitsfile, hdu, columns)
+                for name, hdu, columns in segments]
+
+
+def segmentresults(fitsfile, segments, pending, workers=None):
+    """ Wait for the results of submitsegments. If a worker dies on the
+    way, the segments are analyzed again, once, in a new pool
+    """
+    try:
+        return [future.result() for future in pending]
+    except BrokenProcessPool:
+        log.warning("Segment fit pool broken, retrying %s",
+                    os.path.basename(fitsfile))
+        shutdownpool()
+        return [future.result() for future in
+                submitsegments(fitsfile, segments, workers)]
+
+
+def getampdirection(header, ccdconfig=None):
+    """ Which amplifiers read out the image: 'U', 'L' or 'UL'
+    Args:
+      header (fits.Header): an AMPDIR keyword here wins
+      ccdconfig (str): contents of the CCDDrone ini file the image was
+                       taken with, for its [ccd] AmplifierDirection
+    """
+    if 'AMPDIR' in header:
+        return str(header['AMPDIR']).strip().upper()
+    if ccdconfig:
+        parser = configparser.ConfigParser(inline_comment_prefixes=(';',))
+        try:
+            parser.read_string(ccdconfig)
+            return parser['ccd'].get('AmplifierDirection', 'U').strip().upper()
+        except (configparser.Error, KeyError):
+            pass
+    return 'U'
+
+
+def findsegments(fitsfile, ccdconfig=None):
+    """ Split an image into the parts with their own offset and gain: each
+    image HDU, and within it each amplifier's half of the columns
+    Args:
+      fitsfile (str): path to the image
+      ccdconfig (str): contents of the CCDDrone ini file, see getampdirection
+    Returns:
+      segments (list): (name, hdu, columns) for each part, where columns is
+                       a (start, stop) range or None for all of them
+    """
+    segments = []
+    with fits.open(fitsfile, memmap=True) as hdulist:
+        images = [(index, hdu) for index, hdu in enumerate(hdulist)
+                  if hdu.is_image and hdu.header.get('NAXIS', 0) >= 2
+                  and hdu.name != 'VARIANCE']
+        for index, hdu in images:
+            prefix = f"{index}:" if len(images) > 1 else ""
+            ampdir = getampdirection(hdu.header, ccdconfig)
+            width = hdu.header['NAXIS1']
+            if len(ampdir) == 2 and width >= 2:
+                # each amplifier reads the columns on its side of the middle
+                segments.append((prefix+ampdir[0], index, (0, width // 2)))
+                segments.append((prefix+ampdir[1], index, (width // 2, width)))
+            else:
+                segments.append((prefix+ampdir, index, None))
+    return segments
+
+
+def fitmetrics(damicimage):
+    """ Fit the pixel distribution of an image and compute its metrics
+    Returns:
+      metrics (dict): the computed metrics, formatted as "val +/- err"
+      fitmin (lmfit.MinimizerResult): the Gauss-Poisson fit
+    """
+    # metrics share fits through the cache on damicimage
+    fitmin = poisgaus.computeGausPoissDist(damicimage, npoisson=npoisson)
+    fitparams = poisgaus.parseFitMinimum(fitmin)
+    metrics = {
+        "imageNoise": pd.convertValErrToString(fitparams["sigma"]),
+        "darkCurrent": pd.convertValErrToString(fitparams["lambda"]),
+        "aduEstimate": pd.convertValErrToString(fitparams["ADU"]),
+        "tailRatio": float(pd.computeImageTailRatio(damicimage,
+                                                    npoisson=npoisson)),
+    }
+    return metrics, fitmin
+
+
+def findclusters(data, fitmin, hdu=0, firstcolumn=0):
+    """ Find clusters in an image using the noise, offset and gain of its
+    Gauss-Poisson fit
+    Args:
+      data (ndarray): the 2D image
+      fitmin (lmfit.MinimizerResult): fit of its pixel distribution
+      hdu (int): HDU the image came from, recorded with each cluster
+      firstcolumn (int): column of the HDU where `data` starts
+    Returns:
+      clusters (ndarray): table of clusters, see ClusterFinder.findClusters
+    """
+    if data.ndim != 2:
+        return np.zeros(0, dtype=ClusterFinder.clusterDtype)
+    params = fitmin.params
+    adu = params["ADU"].value
+    clusters = ClusterFinder.findClusters(data, params["sigma"].value,
+                                          params["offset"].value,
+                                          adu=adu if adu > 0 else np.nan)
+    clusters["hdu"] = hdu
+    clusters["x"] += firstcolumn
+    return clusters
+
+
+def loadsegment(fitsfile, hdu=0, columns=None):
+    """ Read one segment of an image, see findsegments
+    Returns:
+      image (ndarray): the whole HDU the segment is in
+      data (ndarray): the segment's columns of it
+      damicimage (DamicImage): the segment, ready to fit
+    """
+    image = fits.getdata(fitsfile, hdu)
+    data = image[..., columns[0]:columns[1]] if columns else image
+    damicimage = DamicImage.DamicImage(data, filename=fitsfile, minRange=200, reverse=False)
+    return image, data, damicimage
+
+
+def analyzesegment(fitsfile, hdu=0, columns=None):
+    """ Compute the metrics and clusters of one segment of an image, see
+    findsegments. Runs in a worker process, so the fit itself isn't returned
+    """
+    image, data, damicimage = loadsegment(fitsfile, hdu, columns)
+    metrics, fitmin = fitmetrics(damicimage)
+    return metrics, findclusters(data, fitmin, hdu, columns[0] if columns else 0)
+
+
+def analyze(fitsfile, spectrumfile=None, output=print, timings=None,
+            ccdconfig=None, workers=None, clusterfile=None, highenergy=1000):
+    """ Fit the pixel distribution of `fitsfile` and report image metrics
+    When the image has several HDUs or was read by two amplifiers, each
+    part has its own offset and gain, so a fit of all of them together
+    doesn't converge. Each part is then fitted on its own instead, the
+    first one here and the others in parallel worker processes, and the
+    top level metrics and spectrum are those of the first part.
+    Args:
+      fitsfile (str): path to the image to analyze
+      spectrumfile (str): if provided, save a plot of the spectrum here
+      output (callable): called with each line of the report
+      timings (dict): if provided, the time (s) taken by the 'load', 'fit',
+                      'segments', 'clusters' and 'plot' steps is stored here
+      ccdconfig (str): contents of the CCDDrone ini file the image was
+                       taken with, to find the amplifiers used
+      workers (int): processes to fit segments in. 1 fits them here
+      clusterfile (str): if provided, save the table of clusters here
+      highenergy (float): clusters with more electrons than this are
+                          counted as high energy
+    Returns:
+      metrics (dict): the computed metrics, formatted as "val +/- err". If
+                      the image has several segments, 'segments' holds the
+                      metrics of each, by name, and 'segment' names the one
+                      the top level metrics are from. 'clusters' summarizes
+                      the clusters found, see ClusterFinder.summarizeClusters
+    """
+    timings = {} if timings is None else timings
+    # start fitting the other segments while the first is fitted here
+    segments = findsegments(fitsfile, ccdconfig)
+    if len(segments) < 2:
+        segments = []
+    segmentstart = monotonic()
+    if len(segments) > 1 and workers != 1:
+        pending = submitsegments(fitsfile, segments[1:], workers)
+    else:
+        pending = None
+
+    start = monotonic()
+    # Read the image, or its first segment, to process
+    name, hdu, columns = segments[0] if segments else (None, 0, None)
+    image, data, damicimage = loadsegment(fitsfile, hdu, columns)
+    timings['load'] = round(monotonic() - start, 3)
+
+    # Compute metrics
+    start = monotonic()
+    metrics, fitmin = fitmetrics(damicimage)
+    timings['fit'] = round(monotonic() - start, 3)
+
+    if segments:
+        first = (dict(metrics),
+                 findclusters(data, fitmin, hdu, columns[0] if columns else 0))
+        if pending is None:
+            results = [analyzesegment(fitsfile, hdu, columns)
+                       for name, hdu, columns in segments[1:]]
+        else:
+            results = segmentresults(fitsfile, segments[1:], pending, workers)
+        results.insert(0, first)
+        metrics['segment'] = segments[0][0]
+        metrics['segments'] = {name: result[0] for (name, hdu, columns), result
+                               in zip(segments, results)}
+        timings['segments'] = round(monotonic() - segmentstart, 3)
+
+    # Find clusters, with each segment's own noise and offset if there are any
+    start = monotonic()
+    if segments:
+        clusters = np.concatenate([result[1] for result in results])
+    else:
+        clusters = findclusters(data, fitmin)
+    metrics['clusters'] = ClusterFinder.summarizeClusters(clusters, highenergy)
+    if clusterfile:
+        ClusterFinder.writeClusters(clusters, clusterfile,
+                                    {'IMAGE': os.path.basename(fitsfile),
+                                     'HIGHE': highenergy})
+    timings['clusters'] = round(monotonic() - start, 3)
+
+    # Print information and metrics
+    output("Image Information:")
+    output(f"\tShape: {image.shape}")
+    output(f"\tMin:   {image.min()}")
+    output(f"\tMax:   {image.max()}")
+    output(f"\tMean:  {round(image.mean(),2)}")
+    output(f"\tStd:   {round(image.std(),2)}")
+
+    if segments:
+        output(f"Image Metrics (segment {metrics['segment']}):")
+    else:
+        output("Image Metrics:")
+    output(f"\tImage Noise [ADU]:               {metrics['imageNoise']}")
+    output(f"\tDark Current [e-/pix/exposure]:  {metrics['darkCurrent']}")
+    output(f"\tPixel to Noise Tail Ratio:       {metrics['tailRatio']}")
+    output(f"\tEstimated e- to ADU Conversion:  {metrics['aduEstimate']}")
+    output(f"\tFits: {damicimage.fitCacheMisses} run, "
+           f"{damicimage.fitCacheHits} reused")
+    output(f"\tClusters:                        {metrics['clusters']['count']}, "
+           f"{metrics['clusters']['highEnergy']} above {highenergy} e-")
+    for name, segment in metrics.get('segments', {}).items():
+        output(f"Segment {name}:")
+        output(f"\tImage Noise [ADU]:               {segment['imageNoise']}")
+        output(f"\tDark Current [e-/pix/exposure]:  {segment['darkCurrent']}")
+        output(f"\tEstimated e- to ADU Conversion:  {segment['aduEstimate']}")
+
+    output("Done")
+
+    if spectrumfile:
+        start = monotonic()
+        # Make histogram of the spectrum and plot fit over it
+        fig, ax = damicimage.plotSpectrum()
+        fitx = np.linspace(damicimage.centers[0], damicimage.centers[-1], 2000)
+        ax.plot(fitx, poisgaus.fGausPoisson(fitx, *poisgaus.paramsToList(fitmin.params)), "--r", linewidth=2)
+        ax.set_yscale("log")
+        ax.set_ylim(0.1, data.size)
+        ax.set_xlim(damicimage.centers[damicimage.centers.size // 3], damicimage.centers[-1])
+
+        # save the image
+        fig.savefig(spectrumfile, bbox_inches="tight")
+        plt.close(fig)
+        timings['plot'] = round(monotonic() - start, 3)
+
+    return metrics
+
+
+def printusage():
+    print(F"Usage: {sys.argv[0]} <fitsfile> [<spectrumfile>] [<ccdconfig>]")
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        printusage()
+
+    fitsfile = sys.argv[1]
+    spectrumfile = (sys.argv[2] if len(sys.argv) > 2
+                    else "static/lastimg_spectrum.png")
+    ccdconfig = None
+    if len(sys.argv) > 3:
+        with open(sys.argv[3]) as f:
+            ccdconfig = f.read()
+    analyze(fitsfile, spectrumfile, ccdconfig=ccdconfig)
+    sys.exit(0)
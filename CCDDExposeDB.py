@@ -1,24 +1,16 @@
 #!/usr/bin/env python3
 from Metadata import validate_metadata
+from Render import makethumbnail
 import sys
 import socket
 import subprocess
 import shutil
 import os
 import json
-import tempfile
 import atexit
 import signal
-from astropy.io import fits
 import time
 
-# Add analysis files
-sys.path.append("analysis")
-import DamicImage
-import PixelDistribution as pd
-import PoissonGausFit as poisgaus 
-import numpy as np
-
 def printusage():
     print(F"Usage: {sys.argv[0]} <exposure> <fitsfile> <metafile> [<thumb>]")
     sys.exit(1)
@@ -96,51 +88,9 @@ time.sleep(1)
 # generate the thumbnail
 if thumb is not None:
     print("Generating png image", flush=True)
-    
-    with tempfile.NamedTemporaryFile(suffix='.png') as tmpfile:
-        tmpname = tmpfile.name
-        run_context(['fits2bitmap', '-o', tmpname, '--percent', '98',fitsfile])
-        run_context(['convert', tmpname, '-scale', '50%', thumb])
-
-
-
-
-# Read average image to process
-data = fits.getdata(fitsfile)
-damicimage = DamicImage.DamicImage(data, filename=fitsfile, minRange=200, reverse=False)
-
-# Compute metrics
-fitmin = poisgaus.computeGausPoissDist(damicimage, npoisson=20)
-fitparams = poisgaus.parseFitMinimum(fitmin)
-imageNoise = pd.convertValErrToString(fitparams["sigma"])
-darkCurrent = pd.convertValErrToString(fitparams["lambda"])
-aduEstimate = pd.convertValErrToString(fitparams["ADU"])
-tailRatio = pd.computeImageTailRatio(damicimage)
-
-# Print information and metrics
-print("Image Information:")
-print("\tShape:", data.shape)
-print("\tMin:  ", data.min())
-print("\tMax:  ", data.max())
-print("\tMean: ", round(data.mean(),2))
-print("\tStd:  ", round(data.std(),2))
-
-print("Image Metrics:")
-print("\tImage Noise [ADU]:              ", imageNoise)
-print("\tDark Current [e-/pix/exposure]: ", darkCurrent)
-print("\tPixel to Noise Tail Ratio:      ", tailRatio)
-print("\tEstimated e- to ADU Conversion: ", aduEstimate)
-    
-print("Done")
-
-# Make histogram of the spectrum and plot fit over it
-fig, ax = damicimage.plotSpectrum()
-fitx = np.linspace(damicimage.centers[0], damicimage.centers[-1], 2000)
-ax.plot(fitx, poisgaus.fGausPoisson(fitx, *poisgaus.paramsToList(fitmin.params)), "--r", linewidth=2)
-ax.set_yscale("log")
-ax.set_ylim(0.1, data.size)
-ax.set_xlim(damicimage.centers[damicimage.centers.size // 3], damicimage.centers[-1])
-
-# save the image
-fig.savefig("static/lastimg_spectrum.png", bbox_inches="tight")
+    makethumbnail(fitsfile, thumb, reduce=2, percent=98)
+
+# analyze the image
+print("Running CCDDAnalyze", flush=True)
+run_context(['./CCDDAnalyze.py', fitsfile, "static/lastimg_spectrum.png"])
 sys.exit(0)
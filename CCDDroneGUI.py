@@ -1,19 +1,24 @@
 from flask import (Flask, render_template, request, redirect, url_for, flash, 
-                   json, make_response, abort, send_file)
+                   json, make_response, abort, send_file, Response, g)
 from flask_bootstrap import Bootstrap
 from flask_basicauth import BasicAuth
 import logging
 from glob import glob
 import ImageDB
+import Sequence
+import Regions
 from forms import ExposeForm
 import sys
 import socket
 import os
 from Executor import Executor
+from Metrics import Metrics
+from ImageCache import ImageCache
+from Tiles import TilePyramid
 from logging.handlers import RotatingFileHandler
 import atexit
-import subprocess
-import tempfile
+import time
+from threading import BoundedSemaphore
 
 
 # some utility functions
@@ -23,6 +28,34 @@ def hostname():
 def system():
     return hostname().split('.')[0]
 
+def _suffixed(filename, device):
+    root, ext = os.path.splitext(filename)
+    return f"{root}_{device}{ext}"
+
+def deviceconfig(config, device, settings):
+    """ Build the Executor config for one of several devices
+    Every file an Executor writes gets the device name appended so devices
+    never share logs, queues, metadata or preview images.
+    Args:
+      config (dict): the application config
+      device (str): name of the device
+      settings (dict): keys from config['DEVICES'][device], which override
+                       the derived values
+    """
+    devconfig = dict(config)
+    for key, default in (('EXECUTOR_LOGFILE', 'logs/Executor.log'),
+                         ('EXECUTOR_QUEUEFILE', 'logs/ExecutorQueue.json'),
+                         ('LASTIMGPATH', 'static/lastimg.png'),
+                         ('CCDDCONFIGFILE', 'config/Config_GUI.ini'),
+                         ('CCDDMETADATAFILE', 'config/Metadata_GUI.json')):
+        if config.get(key, default):
+            devconfig[key] = _suffixed(config.get(key, default), device)
+    devconfig.pop('SPECTRUMPATH', None)
+    devconfig['DATAPATH'] = os.path.join(config.get('DATAPATH', 'data'),
+                                         device)
+    devconfig.update(settings)
+    return devconfig
+
 # create the application
 def create_app(cfgfile=None, instance_path=None):
     
@@ -85,14 +118,50 @@ def create_app(cfgfile=None, instance_path=None):
     # set up handlers
     BasicAuth(app)
     Bootstrap(app)
-    ImageDB.ImageDB(app=app)
-    # executor runs the actual programs
-    app.executor = Executor(app.config)
-    atexit.register(app.executor.abort)
+    imagedb = ImageDB.ImageDB(app=app)
+    # executors run the actual programs, one per device. They run
+    # concurrently, each with its own process, log, queue and expose loop
+    app.metrics = Metrics()
+    devices = app.config.get('DEVICES')
+    if devices:
+        app.executors = {name: Executor(deviceconfig(app.config, name, 
+                                                     settings or {}),
+                                        imagedb=imagedb, name=name,
+                                        metrics=app.metrics)
+                         for name, settings in devices.items()}
+    else:
+        app.executors = {system(): Executor(app.config, imagedb=imagedb,
+                                            name=system(), 
+                                            metrics=app.metrics)}
+    defaultdevice = next(iter(app.executors))
+    # rendered images for the database browser
+    app.imagecache = ImageCache(app.config.get('IMAGECACHE_MB', 256)*1024*1024)
+    app.tiles = TilePyramid(
+        app.config.get('TILECACHE_PATH', 
+                       os.path.join(app.config['DATAPATH'], '.tiles')),
+        tilesize=app.config.get('TILE_SIZE', 256))
+    for executor in app.executors.values():
+        atexit.register(executor.shutdown)
+    # snapshot serials start over in every server process, so status ETags
+    # also name the process that made them
+    startid = format(time.time_ns(), 'x')
+    # every open status stream holds a server thread for its lifetime, so
+    # only this many may be open; other clients poll /api/status instead
+    streamslots = BoundedSemaphore(
+        app.config.get('STATUSSTREAM_MAXCLIENTS', 8))
     
     def getdb():
         return app.extensions['ImageDB']
+
+    def getexecutor():
+        """ Get the Executor for the device selected by this request """
+        return app.executors[g.device]
     
+    def _cachekey(name):
+        """ Key for a cached value belonging to the selected device """
+        key = name+'_'+system()
+        return key+'_'+g.device if devices else key
+
     def _getcache(key):
         return getdb().getcache(key)
     
@@ -101,6 +170,27 @@ def create_app(cfgfile=None, instance_path=None):
     
     app.add_template_global(hostname)
     app.add_template_global(system)
+    app.add_template_global(Sequence.format_duration)
+
+    @app.before_request
+    def selectdevice():
+        g.device = request.args.get('device', defaultdevice)
+        if g.device not in app.executors:
+            abort(404, f"Unknown device '{g.device}'")
+
+    @app.url_defaults
+    def adddevice(endpoint, values):
+        """ Keep links on the device we are looking at """
+        if devices and endpoint != 'static' and 'device' in g:
+            values.setdefault('device', g.device)
+
+    @app.context_processor
+    def deviceinfo():
+        device = g.get('device')
+        return dict(device=device, 
+                    devices=list(app.executors) if devices else [],
+                    ccddpath=(app.executors[device].ccddpath if device
+                              else app.config.get('CCDDRONEPATH')))
 
     @app.template_global()
     def dtype(val):
@@ -108,11 +198,81 @@ def create_app(cfgfile=None, instance_path=None):
 
     @app.route('/')
     def index():
-        return render_template("index.html")
+        return render_template("index.html", 
+                               lastimg=getexecutor().lastimgpath)
 
     @app.route('/api/status')
     def status():
-        return json.jsonify(app.executor.getstatus())
+        """ Status of the selected device. Clients polling with an unchanged
+        status get an empty 304 response
+        """
+        cursor = request.args.get('cursor')
+        executor = getexecutor()
+        serial, _ = executor.getsnapshot()
+        etag = f"{startid}-{g.device}-{serial}-{cursor or ''}"
+        if etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{etag}"', 
+                                                 'Cache-Control': 'no-cache'})
+        response = json.jsonify(executor.getstatus(cursor))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    @app.route('/api/metrics')
+    def metrics():
+        """ Timings, failure counts and queue depths of all devices in the
+        prometheus text format
+        """
+        for executor in app.executors.values():
+            executor.collectmetrics()
+        return Response(app.metrics.render(), 
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.route('/api/statusstream')
+    def statusstream():
+        """ Push the status as server-sent events whenever it changes. When
+        STATUSSTREAM_MAXCLIENTS streams are already open, answer 204, which
+        tells the browser not to reconnect, so it falls back to polling
+        """
+        if not streamslots.acquire(blocking=False):
+            return Response(status=204)
+        # browsers resend the id of the last event when they reconnect
+        cursor = (request.headers.get('Last-Event-ID') or 
+                  request.args.get('cursor'))
+        keepalive = app.config.get('STATUSSTREAM_KEEPALIVE', 15)
+        lifetime = app.config.get('STATUSSTREAM_LIFETIME', 600)
+        executor = getexecutor()
+
+        def events(cursor):
+            yield "retry: 2000\n\n"
+            version = None
+            lastsent = None
+            running = False
+            end = time.time() + lifetime
+            while time.time() < end:
+                # a running process's progress moves without any output, 
+                # so refresh it as often as the snapshot is rebuilt
+                timeout = executor.statusmaxage if running else keepalive
+                newversion = executor.wait_for_change(version, timeout)
+                if newversion == version and not running:
+                    yield ": keep-alive\n\n"
+                    continue
+                version = newversion
+                status = executor.getstatus(cursor)
+                cursor = status['cmdcursor']
+                running = status['state'] == 'running'
+                # statustime changes on every call, so don't compare it
+                compare = dict(status, statustime=None)
+                if compare == lastsent:
+                    continue
+                lastsent = compare
+                yield f"id: {cursor}\ndata: {json.dumps(status)}\n\n"
+
+        response = Response(events(cursor), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache',
+                                     'X-Accel-Buffering': 'no'})
+        response.call_on_close(streamslots.release)
+        return response
 
     @app.errorhandler(RuntimeError)
     @app.errorhandler(FileNotFoundError)
@@ -122,21 +282,24 @@ def create_app(cfgfile=None, instance_path=None):
         
     @app.route('/expose', methods=('GET','POST'))
     def expose():
-        cachekey = 'last_exposure_settings_'+system()
+        cachekey = _cachekey('last_exposure_settings')
         # get the last values we used
         lastvals = _getcache(cachekey)
         if lastvals is None:
             lastvals = {'metadata': {}}
         lastvals['metadata']['SYSTEM'] = system()
+        if devices:
+            lastvals['metadata'].setdefault('DEVICE', g.device)
         form = ExposeForm(request.form, data=lastvals)
         
         if request.method == "POST" and form.validate():
             _setcache(cachekey, form.data)
-            app.executor.savemetadata(form.metadata.data)
-            app.executor.ExposeLoop(form.nexposures.data,
-                                    form.filename.data,
-                                    form.exposure.data)
-            flash('Exposure started', 'success')
+            getexecutor().enqueue('ExposeLoop', 
+                                 nexposures=form.nexposures.data,
+                                 fitsfile=form.filename.data,
+                                 seconds=form.exposure.data,
+                                 metadata=form.metadata.data)
+            flash('Exposure queued', 'success')
             return redirect(url_for('index'))
 
         # always default to 1 exposure for new starts 
@@ -145,32 +308,33 @@ def create_app(cfgfile=None, instance_path=None):
         
     @app.route('/startup', methods=('POST',))
     def startup():
-        app.executor.StartupAndErase()
-        flash('StartupAndErase started', 'success')
+        getexecutor().enqueue('StartupAndErase')
+        flash('StartupAndErase queued', 'success')
         return redirect(url_for('index'))
 
     @app.route('/erase', methods=('POST',))
     def erase():
-        app.executor.PerformEraseProcedure()
-        flash('Erase procedure started', 'success')
+        getexecutor().enqueue('PerformEraseProcedure')
+        flash('Erase procedure queued', 'success')
         return redirect(url_for('index'))
 
     @app.route('/togglebias/<value>', methods=('POST',))
     def togglebias(value):
-        app.executor.ToggleBias(value)
-        flash(f'ToggleBias {value} executed')
+        getexecutor().enqueue('ToggleBias', value=value)
+        flash(f'ToggleBias {value} queued')
         return redirect(url_for('index'))
 
     @app.route('/editconfig', methods=('GET', 'POST'))
     def editconfig():
         if request.method == 'POST':
-            app.executor.saveconfig(request.form['config'],
-                                    'apply' in request.form)
+            getexecutor().saveconfig(request.form['config'], apply=False)
+            if 'apply' in request.form:
+                getexecutor().enqueue('ApplyNewSettings')
             flash("Configuration saved", "success")
             return redirect(url_for('index'))
-        config = app.executor.readconfig()
+        config = getexecutor().readconfig()
         if config is None:
-            flash(f"Unable to load config file {app.executor.outputConfig}",
+            flash(f"Unable to load config file {getexecutor().outputConfig}",
                   'danger')
         return render_template("editconfig.html", 
                                droneconfig=config if config is not None else "")
@@ -178,17 +342,112 @@ def create_app(cfgfile=None, instance_path=None):
 
     @app.route('/abort', methods=('POST', ))
     def abortproc():
-        app.executor.abort()
+        getexecutor().abort()
         flash("Abort submitted", 'warning')
         return redirect(url_for('index'))
 
     @app.route('/endexposeloop', methods=('POST', ))
     def endexposeloop():
-        app.executor.endexposureloop()
+        getexecutor().endexposureloop()
         flash("Exposures will end after current one", 'success')
         return redirect(url_for('index'))
 
 
+    ####### sequence plans ###########
+    def _compilesequence(plan):
+        """ Compile a plan using the last exposure's metadata as default """
+        lastvals = _getcache(_cachekey('last_exposure_settings')) or {}
+        metadata = dict(lastvals.get('metadata', {}), SYSTEM=system())
+        metadata.pop('comments', None)
+        steps = Sequence.compile_plan(plan, metadata)
+        duration = Sequence.estimate_duration(
+            steps, app.config.get('SEQUENCE_DURATIONS'))
+        return steps, duration
+
+    def _queuesequence(plan, steps):
+        name = plan.get('name', 'sequence')
+        return [getexecutor().enqueue(cmd, plan=name, **kwargs)['id']
+                for cmd, kwargs in steps]
+
+    @app.route('/sequence', methods=('GET', 'POST'))
+    def sequence():
+        cachekey = _cachekey('last_sequence')
+        if request.method == 'POST':
+            plantext = request.form['plan']
+            try:
+                plan = Sequence.parse_plan(plantext)
+                steps, duration = _compilesequence(plan)
+            except ValueError as e:
+                flash(f"ERROR: {e}", 'danger')
+                return render_template("sequence.html", plan=plantext)
+            _setcache(cachekey, {'plan': plantext})
+            if 'run' in request.form:
+                _queuesequence(plan, steps)
+                flash(f"Queued {len(steps)} steps, estimated duration "
+                      f"{Sequence.format_duration(duration)}", 'success')
+                return redirect(url_for('index'))
+            labels = [getexecutor().joblabel(cmd, kwargs) 
+                      for cmd, kwargs in steps]
+            return render_template("sequence.html", plan=plantext,
+                                   steps=labels, duration=duration)
+        last = _getcache(cachekey)
+        plantext = last['plan'] if last else Sequence.example_plan
+        return render_template("sequence.html", plan=plantext)
+
+    @app.route('/api/sequence', methods=('POST', ))
+    def sequenceapi():
+        """ Compile (and with run=true, queue) the plan in the json body """
+        req = request.json or {}
+        try:
+            plan = Sequence.parse_plan(req.get('plan'))
+            steps, duration = _compilesequence(plan)
+        except ValueError as e:
+            return json.jsonify({'error': str(e)}), 400
+        result = {'steps': [dict(cmd=cmd, kwargs=kwargs, 
+                                 label=getexecutor().joblabel(cmd, kwargs))
+                            for cmd, kwargs in steps],
+                  'duration': duration, 'queued': []}
+        if req.get('run'):
+            result['queued'] = _queuesequence(plan, steps)
+        return json.jsonify(result)
+
+    ####### job queue endpoints ###########
+    @app.route('/api/queue')
+    def getqueue():
+        return json.jsonify(getexecutor().getqueue())
+
+    @app.route('/queue/<int:jobid>/cancel', methods=('POST', ))
+    def canceljob(jobid):
+        try:
+            getexecutor().canceljob(jobid)
+        except KeyError:
+            abort(404, f"No queued job with id {jobid}")
+        flash("Job cancelled", 'success')
+        return redirect(url_for('index'))
+
+    @app.route('/queue/<int:jobid>/<direction>', methods=('POST', ))
+    def movejob(jobid, direction):
+        offsets = {'up': -1, 'down': 1, 'top': -len(getexecutor().queue)}
+        if direction not in offsets:
+            abort(404)
+        try:
+            getexecutor().movejob(jobid, offsets[direction])
+        except KeyError:
+            abort(404, f"No queued job with id {jobid}")
+        return redirect(url_for('index'))
+
+    @app.route('/queue/pause', methods=('POST', ))
+    def pausequeue():
+        getexecutor().pausequeue(True)
+        flash("Queue paused, the current job will finish", 'warning')
+        return redirect(url_for('index'))
+
+    @app.route('/queue/resume', methods=('POST', ))
+    def resumequeue():
+        getexecutor().pausequeue(False)
+        flash("Queue resumed", 'success')
+        return redirect(url_for('index'))
+
     ####### database browser endpoints ###########
     @app.route('/show/<filename>')
     def showfile(filename):
@@ -197,18 +456,119 @@ def create_app(cfgfile=None, instance_path=None):
             abort(404, f"No registered file with name '{filename}'")
         return render_template('showfile.html',fileinfo=info)
 
-    @app.route('/api/getimg/<filename>')
-    def getimg(filename):
+    def _datafile(filename):
+        """ Find the fits file `filename` or abort with 404 """
         datapath = app.config.get('DATAPATH')
         filepath = os.path.join(datapath, filename)
+        # each device writes to its own directory
+        info = getdb().find_one({'filename': filename}, {'filepath': True})
+        if info and info.get('filepath'):
+            filepath = info['filepath']
         if not os.path.isfile(filepath):
             abort(404, f"Raw fits file '{filename}' not present")
-        with tempfile.NamedTemporaryFile(suffix='.png') as tmpfile:
-            tmpname = tmpfile.name
-            subprocess.run(['fits2bitmap', filepath, '-o', tmpname, 
-                            '--percent', '98'])
-            return send_file(tmpname)
-        return abort(500, "something went wrong sending file...")
+        return filepath
+
+    @app.route('/api/getimg/<filename>')
+    def getimg(filename):
+        filepath = _datafile(filename)
+        try:
+            image = app.imagecache.get(
+                filepath, 
+                reduce=request.args.get('reduce', 1, type=int),
+                percent=request.args.get('percent', 98, type=float),
+                stretch=request.args.get('stretch', 'linear'))
+        except ValueError as e:
+            abort(400, str(e))
+        response = Response(image.data, mimetype='image/png')
+        response.set_etag(image.etag)
+        response.last_modified = image.mtime
+        # the url stays the same when the file changes, so always revalidate
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    @app.route('/api/tiles/<filename>/info')
+    def tileinfo(filename):
+        """ Size and number of zoom levels of the tile pyramid """
+        return json.jsonify(app.tiles.info(_datafile(filename)))
+
+    @app.route('/api/tiles/<filename>/<int:level>/<int:col>_<int:row>.png')
+    def tile(filename, level, col, row):
+        filepath = _datafile(filename)
+        try:
+            tilefile = app.tiles.tile(filepath, level, col, row)
+        except ValueError as e:
+            abort(404, str(e))
+        response = send_file(tilefile, mimetype='image/png', conditional=True)
+        # tiles never change for a given version of the file
+        if request.args.get('v') == app.tiles.info(filepath)['version']:
+            response.cache_control.no_cache = None
+            response.cache_control.max_age = 30*24*3600
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+    def _regionargs():
+        """ Read the hdu and the x0, x1, y0, y1 box from the query string """
+        box = {key: request.args.get(key, type=int)
+               for key in ('x0', 'x1', 'y0', 'y1')}
+        return dict(box, hdu=request.args.get('hdu', 0, type=int),
+                    maxpixels=app.config.get('ROI_MAXPIXELS', 4*1024*1024))
+
+    def _arrayresponse(data, region):
+        """ Send `data` in the format asked for by ?format= """
+        x0, x1, y0, y1 = region
+        fmt = request.args.get('format', 'json')
+        headers = {'X-Region': f"{x0},{x1},{y0},{y1}",
+                   'X-Shape': ','.join(str(n) for n in data.shape),
+                   'X-Dtype': data.dtype.newbyteorder('<').str}
+        if fmt == 'json':
+            return json.jsonify(x0=x0, x1=x1, y0=y0, y1=y1,
+                                shape=data.shape, dtype=data.dtype.name,
+                                data=data.tolist())
+        elif fmt == 'npy':
+            return Response(Regions.tonpy(data), headers=headers,
+                            mimetype='application/octet-stream')
+        elif fmt == 'raw':
+            return Response(Regions.toraw(data), headers=headers,
+                            mimetype='application/octet-stream')
+        abort(400, f"Unknown format '{fmt}', expected json, npy or raw")
+
+    @app.route('/api/roi/<filename>')
+    def roi(filename):
+        """ Pixel values in a box, e.g. ?x0=100&x1=110&y0=0&y1=50 """
+        filepath = _datafile(filename)
+        try:
+            data, region = Regions.readregion(filepath, **_regionargs())
+        except (ValueError, IndexError) as e:
+            abort(400, str(e))
+        return _arrayresponse(data, region)
+
+    @app.route('/api/profile/<filename>')
+    def profile(filename):
+        """ Project a box onto ?axis=x or y, combining pixels with ?stat= """
+        filepath = _datafile(filename)
+        try:
+            data, region = Regions.readprofile(
+                filepath,
+                axis=request.args.get('axis', 'x'),
+                stat=request.args.get('stat', 'mean'),
+                **_regionargs())
+        except (ValueError, IndexError) as e:
+            abort(400, str(e))
+        return _arrayresponse(data, region)
+
+    @app.route('/api/clusters')
+    def clusters():
+        """ Images with at least ?min_high= high energy clusters (default 1),
+        newest first, with their cluster summary
+        """
+        minhigh = request.args.get('min_high', 1, type=int)
+        limit = request.args.get('limit', 100, type=int)
+        cursor = getdb().find({'clusters.highEnergy': {'$gte': minhigh}},
+                              {'_id': False, 'filename': True,
+                               'EXPSTART': True, 'clusters': True},
+                              sort=(('EXPSTART', -1),), limit=limit)
+        return json.jsonify(list(cursor))
 
     def datatableentry(item, colnames):
         """ Format a mongodb result to an object to put in a DataTable """
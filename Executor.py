@@ -1,22 +1,194 @@
 import os
 import sys
+import socket
 import subprocess
 from datetime import datetime
 import logging
-from threading import Thread
+from threading import Thread, Lock, Condition, Event
+from collections import deque
+from types import MappingProxyType
 import json
 import re
-from time import sleep
+from time import time_ns, monotonic
 from ImageDB import ImageDB
-from astropy.visualization.scripts.fits2bitmap import fits2bitmap
+from Metrics import Metrics
+from Metadata import validate_metadata
+from Pipeline import PostProcessor, PostJob
 path = os.path
 log = logging.getLogger(__name__)
 
 
+def collapse_frames(line):
+    """ Reduce a line of carriage-return delimited progress frames to the
+    last non-empty frame
+    """
+    frames = [frame for frame in line.split('\r') if frame]
+    return frames[-1] if frames else ''
+
+
+class OutputLog(object):
+    """ Keep the recent output of CCDD executables in memory
+
+    Output is fed in as it arrives from the process pipe, and each complete
+    line is collapsed to its final progress frame exactly once. Only the
+    last `maxlines` lines are kept, so memory stays flat however long a
+    process runs. Clients keep an opaque cursor and only receive the lines
+    added since they last asked.
+    """
+
+    def __init__(self, maxlines=1000):
+        """
+        Args:
+          maxlines (int): number of complete lines to keep
+        """
+        self.maxlines = maxlines
+        self._lock = Lock()
+        self._clear()
+
+    def _clear(self):
+        self.logid = format(time_ns(), 'x')
+        self._lines = deque(maxlen=self.maxlines)
+        # number of lines added since the last reset
+        self._count = 0
+        self._pending = b''
+        self._lastoutput = None
+
+    def reset(self):
+        """ Forget all output. Call when a new process starts """
+        with self._lock:
+            self._clear()
+
+    def feed(self, data):
+        """ Add a chunk of bytes read from the process output """
+        with self._lock:
+            data = self._pending + data
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].split(b'\n')[:-1]:
+                self._lines.append(
+                    collapse_frames(line.decode(errors='replace')))
+                self._count += 1
+            # only the last complete frame of an unfinished line is 
+            # interesting
+            pending = data[end:]
+            last = pending.rfind(b'\r', 0, max(pending.rfind(b'\r'), 0))
+            self._pending = pending[last+1:]
+            self._lastoutput = datetime.now()
+
+    def addline(self, line):
+        """ Add a complete line of text, e.g. a message from the GUI """
+        with self._lock:
+            self._lines.append(line)
+            self._count += 1
+            self._lastoutput = datetime.now()
+
+    def since(self, cursor=None):
+        """ Get the output added since `cursor`
+        Args:
+          cursor (str): value of `cmdcursor` from a previous call. If None or
+                        no longer valid, all the output kept is returned
+        Returns:
+          dict with keys:
+            cmdoutput (str): new complete lines
+            cmdpartial (str): latest frame of the current unfinished line
+            cmdcursor (str): cursor to send with the next request
+            cmdreset (bool): if True, discard previously received output
+            lastoutput (str): time the last output arrived
+        """
+        with self._lock:
+            first = self._count - len(self._lines)
+            start = None
+            if cursor:
+                logid, _, seen = cursor.partition(':')
+                if (logid == self.logid and seen.isdigit() and 
+                    first <= int(seen) <= self._count):
+                    start = int(seen)
+            newlines = list(self._lines)[(start or first) - first:]
+            lastoutput = None
+            if self._lastoutput is not None:
+                lastoutput = str(self._lastoutput)[:-7]
+            return dict(
+                cmdoutput=''.join(line+'\n' for line in newlines),
+                cmdpartial=collapse_frames(
+                    self._pending.decode(errors='replace')),
+                cmdcursor=f"{self.logid}:{self._count}",
+                cmdreset=start is None,
+                lastoutput=lastoutput,
+            )
+
+
+class ReadoutProgress(object):
+    """ Follow the phase and progress of a CCDD process from its output
+
+    Output is fed in as it arrives from the pipe. Every frame (text between
+    a newline or carriage return) is checked for a phase change, and for a
+    progress bar like "[====] 42%  | Est. time remaining 58s".
+    """
+
+    phases = ((re.compile(r'Starting exposure', re.I), 'exposing'),
+              (re.compile(r'pixels to read', re.I), 'readout'),
+              (re.compile(r'Exposure complete', re.I), 'done'))
+    progressbar = re.compile(r'(\d+(?:\.\d+)?)\s*%'
+                             r'(?:.*?remaining\D*?(\d+(?:\.\d+)?)\s*s)?')
+
+    def __init__(self, exposure=None):
+        """
+        Args:
+          exposure (float): shutter time (s), to report progress while
+                            exposing, when the process prints nothing
+        """
+        self.exposure = exposure
+        self.phase = None
+        self.percent = None
+        self.eta = None
+        self._phasestart = monotonic()
+        self._etatime = None
+        self._pending = b''
+
+    def feed(self, data):
+        """ Parse a chunk of bytes read from the process output """
+        frames = re.split(rb'[\r\n]', self._pending + data)
+        self._pending = frames.pop()
+        for frame in frames:
+            if frame:
+                self._parse(frame.decode(errors='replace'))
+
+    def _parse(self, frame):
+        for pattern, phase in self.phases:
+            if pattern.search(frame):
+                self.phase = phase
+                self._phasestart = monotonic()
+                self.percent = 100. if phase == 'done' else None
+                self.eta = 0. if phase == 'done' else None
+                self._etatime = None
+                return
+        match = self.progressbar.search(frame)
+        if match:
+            self.percent = float(match.group(1))
+            if match.group(2) is not None:
+                self.eta = float(match.group(2))
+                self._etatime = monotonic()
+
+    def todict(self):
+        """ Current phase, percent done and estimated seconds remaining """
+        percent, eta = self.percent, self.eta
+        elapsed = monotonic() - self._phasestart
+        if self.phase == 'exposing' and self.exposure:
+            percent = min(100., 100. * elapsed / self.exposure)
+            eta = max(0., self.exposure - elapsed)
+        elif eta is not None and self._etatime is not None:
+            # count down between updates of the progress bar
+            eta = max(0., eta - (monotonic() - self._etatime))
+        return dict(phase=self.phase, 
+                    percent=None if percent is None else round(percent, 1),
+                    eta=None if eta is None else round(eta, 1),
+                    elapsed=round(elapsed, 1))
+
+
 class Executor(object):
     """ Run CCDD processes and keep track of status """
 
-    def __init__(self, config=None, **kwargs):
+    def __init__(self, config=None, imagedb=None, name=None, metrics=None,
+                 **kwargs):
         """
         Args:
           config (dict): dictionary of config settings. will be merged with 
@@ -24,20 +196,50 @@ class Executor(object):
             CCDDRONEPATH (str): path to top-level of CCDDrone installation
             CCDDCONFIGFILE (str): path (under CCDDrone path) to store config
             CCDDMETADATAFILE (str): path (under CCDDrone path) to store metadata
-            EXECUTOR_LOGFILE (str): where to put logs from CCDD executables
+            EXECUTOR_LOGFILE (str): where to put logs from CCDD executables.
+                                    If None, output is only kept in memory
+            EXECUTOR_OUTPUTLINES (int): lines of output to keep in memory
+            STATUS_MAXAGE (float): seconds before the status of a running
+                                   process is refreshed without any change
             DATAPATH (str): path to save images
             LASTIMGPATH (str): path to save png of last image taken
+            SPECTRUMPATH (str): path to save plot of the last image spectrum
+            EXPOSE_PIPELINED (bool): if True, start the next exposure as soon
+                                     as the fits file is written instead of
+                                     waiting for the PostProcessor
+            EXECUTOR_QUEUEFILE (str): where to persist the job queue
+          Other keys are passed on to the PostProcessor
+          imagedb (ImageDB): connected database for the PostProcessor
+          name (str): name of the device this executor drives
+          metrics (Metrics): where to record timings, labeled with `name`
         """
         def getkey(key, default=None): 
             return kwargs.get(key, config.get(key, default))
+        self.name = name
+        self.metrics = (metrics or Metrics()).labeled(device=name)
         self.logfilename = getkey('EXECUTOR_LOGFILE', 'logs/Executor.log')
-        self.logfile = None
+        self.output = OutputLog(getkey('EXECUTOR_OUTPUTLINES', 1000))
+        self.version = 0
+        self._changed = Condition()
+        self.statusmaxage = getkey('STATUS_MAXAGE', 1)
+        self._snapshot = (0, None, None, None)
+        self._snapshotlock = Lock()
         self.process = None
+        self.progress = None
+        self._pumpthread = None
+        # set once all output of the last process has been read
+        self._outputdone = Event()
+        self._outputdone.set()
         self.current_exposure = None
         self.max_exposures = None
         self.exposethread = None
+        self.loopresult = None
+        self._userabort = False
         self.lastfile=None
         self.lastimgpath = getkey('LASTIMGPATH', 'static/lastimg.png')
+        root, ext = path.splitext(self.lastimgpath or 'static/lastimg.png')
+        self.spectrumpath = getkey('SPECTRUMPATH', root+'_spectrum'+ext)
+        self.pipelined = getkey('EXPOSE_PIPELINED', False)
         self.datapath = getkey("DATAPATH", 'data')
         self.ccddpath = getkey('CCDDRONEPATH')
         CCDDConfigFile = getkey('CCDDCONFIGFILE','config/Config_GUI.ini')
@@ -48,8 +250,8 @@ class Executor(object):
         # make sure the datapath exists
         if not os.path.isdir(self.datapath):
             try:
-                os.mkdir(self.datapath)
-            except FileNotFoundError:
+                os.makedirs(self.datapath)
+            except OSError:
                 raise ValueError(f"DATAPATH '{self.datapath}' does not exist"
                                  "and can't be created")
 
@@ -63,10 +265,89 @@ class Executor(object):
         self.outputConfig = path.abspath(path.join(self.ccddpath, 
                                                    CCDDConfigFile))
         self.outputMetadata = path.join(self.ccddpath, CCDDMetaFile)
+        self.postprocessor = PostProcessor(config, output=self.logmessage,
+                                           onchange=self._notify,
+                                           imagedb=imagedb, 
+                                           metrics=self.metrics, **kwargs)
         log.debug("New executor created, config=%s, meta=%s, imagedb=%s/%s",
                   self.outputConfig, self.outputMetadata, 
                   self.imagedb_uri, self.imagedb_collection)
+
+        # job queue, picked up again after a restart
+        self.queuefile = getkey('EXECUTOR_QUEUEFILE', 
+                                'logs/ExecutorQueue.json')
+        self.queue = []
+        self.jobhistory = deque(maxlen=getkey('EXECUTOR_QUEUEHISTORY', 20))
+        self.currentjob = None
+        self.queuepaused = False
+        self._lastjobid = 0
+        self._shuttingdown = False
+        self._loadqueue()
+        Thread(target=self._schedule, daemon=True, 
+               name=f"Executor-queue-{name}" if name else "Executor-queue"
+               ).start()
         
+    def _notify(self):
+        """ Signal anyone in `wait_for_change` that our status changed """
+        with self._changed:
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait_for_change(self, version=None, timeout=None):
+        """ Block until the status changes
+        Args:
+          version (int): last version seen by the caller. If None, return
+                         the current version immediately
+          timeout (float): maximum time to wait in seconds
+        Returns:
+          version (int): the new version, or `version` if the wait timed out
+        """
+        with self._changed:
+            if version is not None:
+                self._changed.wait_for(lambda: self.version != version,
+                                       timeout)
+            return self.version
+
+    def _pump(self, process, logfile, progress, outputdone):
+        """ Collect the output of `process` as it arrives, follow its
+        progress, and notify on new output and on termination
+        Args:
+          logfile: binary file to copy the output to, or None
+          outputdone (Event): set once all the output has been read
+        """
+        start = monotonic()
+        fd = process.stdout.fileno()
+        try:
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                self.output.feed(data)
+                if logfile:
+                    logfile.write(data)
+                with self._changed:
+                    progress.feed(data)
+                self._notify()
+        finally:
+            if logfile:
+                logfile.close()
+        process.stdout.close()
+        process.wait()
+        outputdone.set()
+        labels = {'command': path.basename(process.args[0])}
+        self.metrics.observe('command_seconds', monotonic() - start, labels)
+        if process.returncode != 0:
+            self.metrics.inc('command_failures_total', labels)
+        self._notify()
+
+    def logmessage(self, message):
+        """ Append a line to the output log """
+        self.output.addline(message)
+        if self.logfilename:
+            with open(self.logfilename, 'a') as f:
+                print(message, file=f)
+        self._notify()
+
     def readconfig(self):
         """ Get the current config file and return as string """
         files = [path.join(self.ccddpath, 'do_not_touch', 'LastSettings.ini'),
@@ -91,6 +372,7 @@ class Executor(object):
         with open(self.outputConfig, 'w') as f:
             f.write(newconf)
         if apply:
+            self._waitoutput()
             self.ApplyNewSettings()
 
     def savemetadata(self, newmeta):
@@ -101,6 +383,17 @@ class Executor(object):
         with open(self.outputMetadata, 'w') as f:
             json.dump(newmeta, f)
 
+    def loadmetadata(self):
+        """ Read and validate the metadata saved for the next exposure
+        Raises:
+          ValueError if the metadata is invalid
+        """
+        with open(self.outputMetadata) as f:
+            metadata = json.load(f)
+        metadata.setdefault('SYSTEM', socket.gethostname().split('.')[0])
+        validate_metadata(metadata)
+        return metadata
+
     def getstate(self):
         state = 'idle'
         if self.process:
@@ -112,32 +405,31 @@ class Executor(object):
             state = 'running'
         return state
 
-    def getstatus(self):
-        """ Get out current status as a dict """
-        status = dict(state=self.getstate(), runningcmd=None,
+    def collectmetrics(self):
+        """ Record the current queue depths as gauges """
+        self.metrics.set('queue_jobs', len(self.queue))
+        self.postprocessor.collectmetrics()
+
+    def _buildstatus(self):
+        """ Gather everything in the status except the program output """
+        status = dict(device=self.name, state=self.getstate(), 
+                      runningcmd=None,
                       current_exposure=self.current_exposure,
                       max_exposures=self.max_exposures,
                       statustime=str(datetime.now())[:-7],
-                      lastfile=self.lastfile)
+                      lastfile=self.lastfile, progress=None)
         if self.process:
             status['lastcmd'] = self.process.args[0]
             status['lastreturn'] = self.process.poll()
             if status['state'] == 'running':
                 status['runningcmd'] = path.basename(self.process.args[0])
-        try:
-            with open(self.logfilename, newline='') as logfile:
-                ts = datetime.fromtimestamp(path.getmtime(self.logfilename))
-                status['cmdoutput'] = f"Last output: {str(ts)[:-7]}\n"
-                status['cmdoutput'] += '#'*80+'\n'
-                lines = logfile.readlines()
-                if lines and lines[-1][-1] == '\r':
-                    lines[-1] = lines[-1][:-1]
-                for line in lines:
-                    if not line.endswith('\r'):
-                        status['cmdoutput'] += line
-        except FileNotFoundError:
-            status['cmdoutput'] = ""
-        
+        if self.progress:
+            with self._changed:
+                status['progress'] = self.progress.todict()
+
+        status['pipeline'] = self.postprocessor.getstatus()
+        status['queue'] = self.getqueue()
+
         # info for the lastimg to update
         status['lastimg'] = self.lastimgpath
         try:
@@ -146,40 +438,110 @@ class Executor(object):
             status['lastimg_timestamp'] = 0
         return status
 
+    def getsnapshot(self):
+        """ Get the status shared by all viewers, rebuilding it only if 
+        something changed since it was made. While a process runs it is also
+        rebuilt every `statusmaxage` seconds so the progress keeps moving.
+        Returns:
+          snapshot (tuple): serial number, which changes on every rebuild,
+                            and read-only status dict without the output
+        """
+        with self._snapshotlock:
+            serial, status, version, built = self._snapshot
+            stale = (version != self.version or 
+                     (status is not None and status['state'] == 'running' and
+                      monotonic() - built > self.statusmaxage))
+            if status is None or stale:
+                # changes while we build will cause the next rebuild
+                version = self.version
+                status = MappingProxyType(self._buildstatus())
+                serial += 1
+                self._snapshot = (serial, status, version, monotonic())
+            return serial, status
+
+    def getstatus(self, cursor=None):
+        """ Get out current status as a dict
+        Args:
+          cursor (str): `cmdcursor` returned by a previous call; only output
+                        produced since then is included
+        """
+        serial, snapshot = self.getsnapshot()
+        status = dict(snapshot)
+        status.update(self.output.since(cursor))
+        return status
+
     def endexposureloop(self):
         """ Stop an ongoing exposure loop """
-        self.max_exposures = self.current_exposure
+        with self._changed:
+            self.max_exposures = self.current_exposure
+            self._notify()
 
     def abort(self, kill=False):
         """ abort a currently running process """
         log.warning("Received abort request")
-        self.current_exposure = None
-        if self.getstate() == 'running':
-            if kill:
-                self.process.kill()
-            else:
-                self.process.terminate()
-            with open(self.logfilename, 'a') as f:
-                print("!!!!!! process killed by user !!!!!!!", file=f)
+        # the expose loop holds this lock while starting a new exposure
+        with self._changed:
+            running = self.getstate() == 'running'
+            self.current_exposure = None
+            if running:
+                self._userabort = True
+            if self.getstate() == 'running':
+                if kill:
+                    self.process.kill()
+                else:
+                    self.process.terminate()
+                self.logmessage("!!!!!! process killed by user !!!!!!!")
+            self._notify()
 
     # methods to run exectuables
-    def _run(self, args, cwd=None, env=None, logmode='wb'):
-        """ Run the commands in `args` in a subprocess """
+    def _run(self, args, cwd=None, env=None, logmode='wb', exposure=None):
+        """ Run the commands in `args` in a subprocess 
+        Args:
+          exposure (float): shutter time, if the process takes an image
+        """
         args = tuple(str(arg) for arg in args)
         if self.process and self.process.poll() is None: 
             raise RuntimeError("A process is already running")
-        if self.logfile:
-            self.logfile.close()
-        self.logfile = open(self.logfilename, logmode, buffering=0)
+        # callers often hold self._changed, which the pump of the last 
+        # process needs, so they wait for its output with _waitoutput first
+        if 'a' not in logmode:
+            self.output.reset()
+            if self.logfilename:
+                open(self.logfilename, logmode).close()
+        # always append, so lines from logmessage are not overwritten
+        logfile = None
+        if self.logfilename:
+            logfile = open(self.logfilename, 'ab', buffering=0)
         if env is not None:
             env = dict(os.environ, **env, 
                        PYTHONPATH=os.pathsep.join(sys.path))
            
-        self.process = subprocess.Popen(args, cwd=cwd, stdout=self.logfile,
-                                        stderr=subprocess.STDOUT, env=env)
+        try:
+            self.process = subprocess.Popen(args, cwd=cwd, 
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, env=env)
+        except Exception:
+            if logfile:
+                logfile.close()
+            raise
+        self.progress = ReadoutProgress(exposure)
+        self._outputdone = Event()
+        self._pumpthread = Thread(target=self._pump, daemon=True,
+                                  args=(self.process, logfile, self.progress,
+                                        self._outputdone))
+        self._pumpthread.start()
+        self._notify()
+        return self.process
 
         
 
+    def _waitoutput(self, timeout=5):
+        """ Wait until the output of the last process has been read, so it
+        reaches the log before the next process truncates it. Don't hold 
+        self._changed while calling this
+        """
+        self._outputdone.wait(timeout)
+
     def StartupAndErase(self):
         return self._run(['./CCDDStartupAndErase', path.abspath(self.outputConfig)], 
                          cwd=self.ccddpath)
@@ -207,34 +569,83 @@ class Executor(object):
         elif match.group(1) != tstamp:
             fitsfile = fitsfile[:-17] + tstamp + '.fits'
             
-        fitsfile = path.join(self.datapath, fitsfile)
+        fitsfile = path.abspath(path.join(self.datapath, fitsfile))
+        # back-to-back exposures can start within the same minute
+        base, index = fitsfile[:-5], 1
+        while path.exists(fitsfile):
+            index += 1
+            fitsfile = f"{base}_{index}.fits"
 
         self.lastfile = fitsfile
         log.info("Starting new exposure, filename=%s",
                  path.basename(self.lastfile))
-        args = ['./CCDDExposeDB.py', str(seconds), fitsfile, 
-                self.outputMetadata]
-        if self.lastimgpath:
-            args.append(self.lastimgpath)
-        return self._run(args, 
-                         env=dict(IMAGEDB_URI=self.imagedb_uri,
-                                  IMAGEDB_COLLECTION=self.imagedb_collection)
-                     )
+        return self._run(['./CCDDExpose', str(seconds), fitsfile], 
+                         cwd=self.ccddpath, exposure=float(seconds))
 
     def _do_expose_loop(self, fitsfile, seconds):
         """ private method to perform expose loop. Do not call directly! """
         log.debug(f"Starting expose loop with {self.max_exposures} exposures")
-        while (self.current_exposure is not None and 
-               self.current_exposure < self.max_exposures):
-            self.current_exposure += 1
-            self.Expose(fitsfile, seconds)
-            while self.process and self.process.poll() is None:
-                sleep(5)
-            if not self.process or self.process.returncode != 0:
-                break
-            
-        self.current_exposure = None
-        self.max_exposures = None
+        nexposures = self.max_exposures
+        lastend = None
+        try:
+            # settings can't be applied while we are exposing
+            ccdconfig = self.readconfig()
+            while True:
+                self._waitoutput()
+                # abort and endexposureloop change the counters under the
+                # same lock, so they can't slip in between check and start
+                with self._changed:
+                    if (self.current_exposure is None or 
+                        self.current_exposure >= self.max_exposures):
+                        break
+                    self.current_exposure += 1
+                    metadata = self.loadmetadata()
+                    process = self.Expose(fitsfile, seconds)
+                # dead time lasts until the new process is running, and the
+                # shutter and readout are timed from there
+                start = monotonic()
+                timings = {}
+                if lastend is not None:
+                    timings['deadtime'] = round(start - lastend, 3)
+                    self.metrics.observe('deadtime_seconds', 
+                                         timings['deadtime'])
+                # returns as soon as the exposure finishes or is aborted
+                if process.wait() != 0:
+                    self.loopresult = 'failed'
+                    break
+                lastend = monotonic()
+                timings['expose'] = round(lastend - start, 3)
+                # blocks if post-processing has fallen too far behind
+                job = self.postprocessor.submit(
+                    PostJob(self.lastfile, metadata, thumb=self.lastimgpath,
+                            spectrum=self.spectrumpath, timings=timings,
+                            ccdconfig=ccdconfig))
+                if not self.pipelined:
+                    self._waitpostjob(job, nexposures)
+        except Exception as e:
+            log.exception("Exposure loop failed")
+            self.logmessage(f"Exposure loop stopped: {e}")
+            self.loopresult = 'failed'
+        finally:
+            with self._changed:
+                self.current_exposure = None
+                self.max_exposures = None
+                self._notify()
+
+    def _waitpostjob(self, job, nexposures):
+        """ Wait for `job` to finish post-processing, unless the loop it
+        belongs to is aborted or ended early in the meantime. Both, and the
+        end of post-processing, notify self._changed
+        """
+        def stopped():
+            return (self.current_exposure is None or
+                    self.max_exposures is None or
+                    self.max_exposures < nexposures)
+        with self._changed:
+            self._changed.wait_for(lambda: job.done.is_set() or stopped())
+        if not job.done.is_set():
+            log.info("Expose loop stopped, not waiting for processing of %s",
+                     path.basename(job.fitsfile))
 
     def ExposeLoop(self, nexposures, fitsfile, seconds=5):
         """ Take multiple exposures in a loop """
@@ -245,6 +656,7 @@ class Executor(object):
 
         self.current_exposure = 0
         self.max_exposures = nexposures
+        self.loopresult = 'done'
         self.exposethread = Thread(target=self._do_expose_loop,
                                    args=(fitsfile, seconds))
         self.exposethread.start()
@@ -253,3 +665,195 @@ class Executor(object):
         """ Toggle the bias on or off """
         return self._run(['./CCDDToggleBias', value], 
                          cwd=self.ccddpath)
+
+    # the job queue
+    queueable = ('StartupAndErase', 'PerformEraseProcedure', 
+                 'ApplyNewSettings', 'ToggleBias', 'ExposeLoop')
+
+    @staticmethod
+    def joblabel(cmd, kwargs):
+        """ Human readable description of a queued command """
+        if cmd == 'ExposeLoop':
+            return (f"Expose {kwargs['nexposures']} x "
+                    f"{kwargs.get('seconds', 5)} s, {kwargs['fitsfile']}")
+        elif cmd == 'ToggleBias':
+            return f"ToggleBias {kwargs['value']}"
+        return cmd
+
+    def enqueue(self, cmd, plan=None, **kwargs):
+        """ Add a command to the end of the job queue. It runs as soon as 
+        everything queued before it has finished.
+        Args:
+          cmd (str): name of the method to call, one of `queueable`
+          plan (str): name of the sequence plan the job belongs to, if any
+          kwargs: arguments for the method. ExposeLoop also takes a 
+                  `metadata` dict, which is saved just before it starts
+        Returns:
+          job (dict): the new queue entry
+        """
+        if cmd not in self.queueable:
+            raise ValueError(f"Can't queue unknown command '{cmd}'")
+        with self._changed:
+            self._lastjobid += 1
+            job = dict(id=self._lastjobid, cmd=cmd, kwargs=kwargs, 
+                       label=self.joblabel(cmd, kwargs), state='queued',
+                       queued=str(datetime.now())[:-7], plan=plan)
+            self.queue.append(job)
+            self._jobchanged()
+        return job
+
+    def _findjob(self, jobid):
+        for index, job in enumerate(self.queue):
+            if job['id'] == jobid:
+                return index
+        raise KeyError(f"No queued job with id {jobid}")
+
+    def canceljob(self, jobid):
+        """ Remove a job that has not started yet from the queue """
+        with self._changed:
+            job = self.queue.pop(self._findjob(jobid))
+            job['state'] = 'cancelled'
+            self.jobhistory.append(job)
+            self._jobchanged()
+
+    def movejob(self, jobid, offset):
+        """ Move a queued job `offset` places later (negative for earlier) """
+        with self._changed:
+            index = self._findjob(jobid)
+            job = self.queue.pop(index)
+            newindex = min(max(index + offset, 0), len(self.queue))
+            self.queue.insert(newindex, job)
+            self._jobchanged()
+
+    def pausequeue(self, pause=True):
+        """ Stop (or with pause=False, resume) starting new jobs """
+        with self._changed:
+            self.queuepaused = pause
+            self._jobchanged()
+
+    def getqueue(self):
+        """ Get the current, queued and recently finished jobs """
+        with self._changed:
+            return dict(paused=self.queuepaused, current=self.currentjob,
+                        jobs=list(self.queue), history=list(self.jobhistory))
+
+    def _jobchanged(self):
+        """ Persist the queue and tell everyone. Hold self._changed """
+        self._savequeue()
+        self._notify()
+
+    def _savequeue(self):
+        state = dict(paused=self.queuepaused, lastjobid=self._lastjobid,
+                     current=self.currentjob, queue=self.queue, 
+                     history=list(self.jobhistory))
+        try:
+            with open(self.queuefile+'.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self.queuefile+'.tmp', self.queuefile)
+        except OSError as e:
+            log.error("Unable to save job queue to %s: %s", self.queuefile, e)
+
+    def _loadqueue(self):
+        try:
+            with open(self.queuefile) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.error("Unable to load job queue from %s: %s", 
+                      self.queuefile, e)
+            return
+        self.queuepaused = state.get('paused', False)
+        self._lastjobid = state.get('lastjobid', 0)
+        self.queue = state.get('queue', [])
+        self.jobhistory.extend(state.get('history', []))
+        current = state.get('current')
+        if current:
+            # we went down without a chance to clean up. Run it again
+            log.warning("Requeueing interrupted job %s", current['label'])
+            current['state'] = 'queued'
+            self.queue.insert(0, current)
+        log.info("Loaded %d queued jobs from %s", len(self.queue),
+                 self.queuefile)
+
+    def _busy(self):
+        # the scheduler waits holding self._changed, so it can't 
+        # _waitoutput; the pump notifies once the output is read
+        return ((self.process and self.process.poll() is None) or
+                not self._outputdone.is_set() or
+                (self.exposethread and self.exposethread.is_alive()))
+
+    def _readyfornext(self):
+        return (self.queue and not self.queuepaused and 
+                not self._shuttingdown and not self._busy())
+
+    def _startjob(self, job):
+        kwargs = dict(job['kwargs'])
+        if job['cmd'] == 'ExposeLoop':
+            metadata = kwargs.pop('metadata', None)
+            if metadata is not None:
+                self.savemetadata(metadata)
+        getattr(self, job['cmd'])(**kwargs)
+
+    def _waitjob(self, job):
+        """ Wait for the job to end and return its final state """
+        if job['cmd'] == 'ExposeLoop':
+            self.exposethread.join()
+            result = self.loopresult
+        else:
+            result = 'done' if self.process.wait() == 0 else 'failed'
+        if self._userabort:
+            result = 'aborted'
+        return result
+
+    def _schedule(self):
+        """ Start queued jobs as soon as the previous one ends """
+        while True:
+            with self._changed:
+                self._changed.wait_for(self._readyfornext)
+                job = self.queue.pop(0)
+                job['state'] = 'running'
+                job['started'] = str(datetime.now())[:-7]
+                self.currentjob = job
+                self._userabort = False
+                try:
+                    self._startjob(job)
+                    result = None
+                except Exception as e:
+                    log.exception("Unable to start job %s", job['label'])
+                    job['error'] = str(e)
+                    result = 'failed'
+                self._jobchanged()
+            if result is None:
+                result = self._waitjob(job)
+            with self._changed:
+                if self._shuttingdown:
+                    # shutdown() already put the job back in the queue
+                    return
+                job['state'] = result
+                job['finished'] = str(datetime.now())[:-7]
+                self.currentjob = None
+                self.jobhistory.append(job)
+                if result != 'done':
+                    # don't run the next steps on top of a failed one
+                    log.warning("Job %s %s, pausing queue", job['label'], 
+                                result)
+                    self.queuepaused = True
+                self._jobchanged()
+
+    def shutdown(self):
+        """ Stop everything, leaving unfinished jobs queued for next start """
+        with self._changed:
+            self._shuttingdown = True
+            job = self.currentjob
+            if job:
+                job['state'] = 'queued'
+                if job['cmd'] == 'ExposeLoop' and self.current_exposure:
+                    # the exposure in progress is lost, redo it
+                    job['kwargs']['nexposures'] -= self.current_exposure - 1
+                    job['label'] = self.joblabel(job['cmd'], job['kwargs'])
+                self.queue.insert(0, job)
+                self.currentjob = None
+            self._savequeue()
+        self.abort()
+        self.postprocessor.shutdown()
@@ -0,0 +1,99 @@
+""" Size-bounded cache of images rendered from fits files """
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from Render import renderpng
+path = os.path
+log = logging.getLogger(__name__)
+
+
+class CachedImage(object):
+    """ A rendered image and the validators to send with it """
+
+    def __init__(self, data, etag, mtime):
+        self.data = data
+        self.etag = etag
+        self.mtime = mtime
+
+
+class ImageCache(object):
+    """ Least-recently-used cache of rendered images, kept in memory
+
+    Entries are keyed by the file path, its modification time and size, and
+    the render parameters, so a rewritten file is never served stale. When
+    several requests ask for an image that is not cached yet, only the
+    first renders it and the others wait for its result.
+    """
+
+    def __init__(self, maxbytes=256*1024*1024):
+        """
+        Args:
+          maxbytes (int): total size of cached images before the least
+                          recently used are dropped
+        """
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = Lock()
+
+    def get(self, fitsfile, render=renderpng, **params):
+        """ Get the image rendered from `fitsfile`, rendering it if needed
+        Args:
+          fitsfile (str): path to the fits file
+          render (callable): called as render(fitsfile, **params) to make
+                             the image bytes
+          params: render parameters, part of the cache key
+        Returns:
+          image (CachedImage)
+        Raises:
+          FileNotFoundError if `fitsfile` doesn't exist, or anything raised
+          by `render`
+        """
+        stat = os.stat(fitsfile)
+        key = (path.abspath(fitsfile), stat.st_mtime_ns, stat.st_size,
+               render.__name__, tuple(sorted(params.items())))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+        if not owner:
+            return future.result()
+
+        try:
+            data = render(fitsfile, **params)
+            etag = hashlib.sha1(repr(key).encode()).hexdigest()[:20]
+            entry = CachedImage(data, etag, stat.st_mtime)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._store(key, entry)
+            del self._inflight[key]
+        future.set_result(entry)
+        return entry
+
+    def _store(self, key, entry):
+        """ Add an entry and drop old ones to fit. Hold self._lock """
+        if len(entry.data) > self.maxbytes:
+            return
+        self._entries[key] = entry
+        self.size += len(entry.data)
+        while self.size > self.maxbytes:
+            oldkey, old = self._entries.popitem(last=False)
+            self.size -= len(old.data)
+            log.debug("Dropped %s from image cache", oldkey[0])
@@ -61,6 +61,7 @@ class ImageDB(object):
         self.collection.create_index('filename', unique=True)
         self.collection.create_index('EXPSTART')
         self.collection.create_index('RUNTYPE')
+        self.collection.create_index('clusters.highEnergy')
 
     def getconfig(self):
         dbconfig = self.collection.config.find_one({'_id': __name__})
@@ -110,6 +111,15 @@ class ImageDB(object):
             self.collection.replace_one(search, metadata, upsert=True)
             return self.collection.find_one(search, {'_id': True})['_id']
 
+    def update(self, filename, fields):
+        """ Set `fields` on the existing entry for `filename`
+        Args:
+          filename (str): path or name of the fits file
+          fields (dict): keys and values to set
+        """
+        search = dict(filename=os.path.basename(filename))
+        return self.collection.update_one(search, {'$set': fields})
+
     def find(self, *args, **kwargs):
         """ Run find command against the image collection. Args are passed
         directly to `pymongo.Collection.find`.
@@ -0,0 +1,132 @@
+""" In-process counters, gauges and timing summaries for the GUI, reported in
+the Prometheus text exposition format at /api/metrics
+"""
+import threading
+from time import monotonic
+from contextlib import contextmanager
+
+# help text for each metric, also fixes the prometheus type
+descriptions = {
+    'command_seconds': ('summary', "Run time of CCDD executables"),
+    'command_failures_total': ('counter',
+                               "CCDD executables that exited with an error"),
+    'exposure_seconds': ('summary', "Shutter time from the fits header"),
+    'readout_seconds': ('summary', "Readout time from the fits header"),
+    'deadtime_seconds': ('summary',
+                         "Time between exposures of an exposure loop"),
+    'images_total': ('counter', "Images handed to post-processing"),
+    'pipeline_wait_seconds': ('summary',
+                              "Time the exposure loop waited for a free "
+                              "post-processing slot"),
+    'pipeline_stage_seconds': ('summary', "Run time of post-processing stages"),
+    'pipeline_stage_failures_total': ('counter',
+                                      "Post-processing stages that failed"),
+    'analysis_step_seconds': ('summary', "Run time of steps of the analysis"),
+    'queue_jobs': ('gauge', "Jobs waiting in the executor queue"),
+    'pipeline_pending': ('gauge', "Images not yet through post-processing"),
+    'pipeline_stage_queue': ('gauge',
+                             "Images waiting for a post-processing stage"),
+}
+
+
+def _formatlabels(labels):
+    if not labels:
+        return ''
+    def escape(val):
+        return str(val).replace('\\', '\\\\').replace('"', '\\"')
+    return '{' + ','.join(f'{key}="{escape(val)}"' 
+                          for key, val in labels) + '}'
+
+
+class Metrics(object):
+    """ Thread-safe store of metric values keyed by name and labels.
+
+    `labeled` returns a view sharing the same store that adds fixed labels
+    to everything it records, so each Executor can tag its values with its
+    device while one endpoint reports them all.
+    """
+
+    def __init__(self, prefix='ccddrone', _parent=None, **labels):
+        """
+        Args:
+          prefix (str): prepended to every metric name
+          labels: labels added to every value recorded through this object
+        """
+        if _parent is None:
+            self.prefix = prefix
+            self._lock = threading.Lock()
+            self._values = {}
+            self.labels = labels
+        else:
+            self.prefix = _parent.prefix
+            self._lock = _parent._lock
+            self._values = _parent._values
+            self.labels = dict(_parent.labels, **labels)
+
+    def labeled(self, **labels):
+        """ Get a view of this store that adds `labels` to every value """
+        return Metrics(_parent=self, **labels)
+
+    def _key(self, name, labels):
+        if name not in descriptions:
+            raise KeyError(f"Unknown metric '{name}'")
+        labels = dict(self.labels, **(labels or {}))
+        return name, tuple(sorted((key, str(val)) for key, val in 
+                                  labels.items() if val is not None))
+
+    def inc(self, name, labels=None, value=1):
+        """ Add `value` to the counter `name` """
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        """ Set the gauge `name` to `value` """
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, seconds, labels=None):
+        """ Add a duration to the summary `name` """
+        key = self._key(name, labels)
+        with self._lock:
+            count, total = self._values.get(key, (0, 0.))
+            self._values[key] = (count + 1, total + seconds)
+
+    @contextmanager
+    def timer(self, name, labels=None, timings=None, timingkey=None):
+        """ Time the body of a `with` statement and observe it as `name`
+        Args:
+          timings (dict): if given, also store the duration here under
+                          `timingkey`, e.g. to save it with the image
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            elapsed = monotonic() - start
+            self.observe(name, elapsed, labels)
+            if timings is not None:
+                timings[timingkey] = round(elapsed, 3)
+
+    def render(self):
+        """ Format all values in the prometheus text format """
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = []
+        lastname = None
+        for (name, labels), value in values:
+            fullname = f"{self.prefix}_{name}"
+            mtype, helptext = descriptions[name]
+            if name != lastname:
+                lines.append(f"# HELP {fullname} {helptext}")
+                lines.append(f"# TYPE {fullname} {mtype}")
+                lastname = name
+            labeltext = _formatlabels(labels)
+            if mtype == 'summary':
+                count, total = value
+                lines.append(f"{fullname}_count{labeltext} {count}")
+                lines.append(f"{fullname}_sum{labeltext} {total:.6f}")
+            else:
+                lines.append(f"{fullname}{labeltext} {value}")
+        return '\n'.join(lines) + '\n'
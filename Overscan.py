@@ -0,0 +1,180 @@
+""" Subtract the bias level measured in the overscan of CCD images """
+import os
+import configparser
+import numpy as np
+from astropy.io import fits
+from Render import readimage
+from Regions import applyscale
+path = os.path
+
+
+def getoverscan(header, ccdconfig=None, columns=0, rows=0):
+    """ Number of overscan columns and rows of an image
+    Args:
+      header (fits.Header): OVRSCANX and OVRSCANY keywords here win
+      ccdconfig (str): contents of the CCDDrone ini file the image was
+                       taken with, for overscan_columns and overscan_rows
+                       in its [ccd] section
+      columns, rows (int): used when neither of the above says
+    Returns:
+      columns, rows (int): overscan columns of each amplifier, and rows
+    """
+    if ccdconfig:
+        parser = configparser.ConfigParser(inline_comment_prefixes=(';',))
+        try:
+            parser.read_string(ccdconfig)
+            columns = parser['ccd'].getint('overscan_columns', columns)
+            rows = parser['ccd'].getint('overscan_rows', rows)
+        except (configparser.Error, KeyError, ValueError):
+            pass
+    return (int(header.get('OVRSCANX', columns)),
+            int(header.get('OVRSCANY', rows)))
+
+
+def correctedpath(fitsfile):
+    """ Where the bias subtracted image of `fitsfile` is written """
+    root, ext = path.splitext(fitsfile)
+    return f"{root}_corrected{ext}"
+
+
+def layout(width, columns, ampdir='U'):
+    """ Where each amplifier's image and overscan columns are
+    Each amplifier reads `columns` overscan pixels after each row of its
+    part of the image: the last columns for a single amplifier, and the
+    columns either side of the middle when two read opposite halves.
+    Returns:
+      parts (list): (active, overscan) column slices for each amplifier
+    """
+    if len(ampdir) == 2:
+        middle = width // 2
+        parts = [(np.s_[0:middle-columns], np.s_[middle-columns:middle]),
+                 (np.s_[middle+columns:width], np.s_[middle:middle+columns])]
+    else:
+        parts = [(np.s_[0:width-columns], np.s_[width-columns:width])]
+    for active, overscan in parts:
+        if active.stop <= active.start:
+            raise ValueError(f"{columns} overscan columns leave no image")
+    return parts
+
+
+def rowbias(data, parts):
+    """ Subtract the median of each row of an amplifier's overscan from
+    that row of its part of `data`, in place. `parts` is from `layout`
+    """
+    for active, overscan in parts:
+        bias = np.median(data[:, overscan], axis=1)
+        data[:, active] -= bias[:, None]
+
+
+def subtract(data, columns, rows=0, ampdir='U'):
+    """ Subtract the bias and trim the overscan of an image
+    The median of each row of an amplifier's overscan is subtracted from
+    that row of its part of the image, see `layout`. The median of each
+    column over the `rows` overscan rows read last is then subtracted from
+    every column.
+    Args:
+      data (ndarray): 2D float image, modified in place
+      columns (int): overscan columns of each amplifier
+      rows (int): overscan rows at the end of the image
+      ampdir (str): 'U', 'L' or 'UL', the amplifiers used
+    Returns:
+      image (ndarray): the corrected image without the overscan
+    """
+    height, width = data.shape
+    if rows >= height:
+        raise ValueError(f"{rows} overscan rows leave no image")
+    if columns:
+        rowbias(data, layout(width, columns, ampdir))
+    if rows:
+        data -= np.median(data[height-rows:], axis=0)
+    return trim(data, columns, rows, ampdir)
+
+
+def subtractraw(raw, scale, columns, rows=0, ampdir='U',
+                chunkbytes=64*1024*1024):
+    """ The same as `subtract` of the scaled float32 image, reading the raw
+    values a block of rows at a time, so a memory map is never copied
+    whole. The row bias of each block only needs its own rows, and the
+    column bias only the overscan rows, which are corrected first.
+    Args:
+      raw (ndarray): 2D raw values, as from `readimage`
+      scale (tuple): (bscale, bzero) to apply to them
+      columns, rows, ampdir: describe the overscan, see `subtract`
+      chunkbytes (int): approximate size of each block
+    Returns:
+      image (ndarray): float32 corrected image without the overscan
+    """
+    height, width = raw.shape
+    if rows >= height:
+        raise ValueError(f"{rows} overscan rows leave no image")
+    parts = layout(width, columns, ampdir)
+
+    def readblock(start, stop):
+        data = applyscale(raw[start:stop], scale).astype(np.float32)
+        if columns:
+            rowbias(data, parts)
+        return data
+
+    columnbias = 0
+    if rows:
+        columnbias = np.median(readblock(height-rows, height), axis=0)
+    image = np.empty((height - rows,
+                      sum(active.stop - active.start for active, _ in parts)),
+                     dtype=np.float32)
+    chunkrows = max(1, chunkbytes // (width * 8))
+    for start in range(0, height - rows, chunkrows):
+        stop = min(height - rows, start + chunkrows)
+        image[start:stop] = trim(readblock(start, stop) - columnbias,
+                                 columns, 0, ampdir)
+    return image
+
+
+def trim(data, columns, rows=0, ampdir='U'):
+    """ Remove the overscan of `data` without changing any values """
+    height, width = data.shape
+    image = data[:height-rows]
+    return np.hstack([image[:, active]
+                      for active, overscan in layout(width, columns, ampdir)])
+
+
+def correct(fitsfile, columns, rows=0, ampdir='U', outfile=None,
+            chunkbytes=64*1024*1024):
+    """ Write the bias subtracted, trimmed image of `fitsfile`
+    A result newer than `fitsfile` and made with the same overscan and
+    amplifiers is reused rather than recomputed. A VARIANCE extension, as
+    written for combined skipper images, is trimmed the same way and copied.
+    Args:
+      fitsfile (str): path to the image
+      columns, rows, ampdir: describe the overscan, see `subtract`
+      outfile (str): where to write the result, default `correctedpath`
+      chunkbytes (int): raw image to read at once, see `subtractraw`
+    Returns:
+      outfile (str): the written file
+    """
+    outfile = outfile or correctedpath(fitsfile)
+    if (path.isfile(outfile) and
+        path.getmtime(outfile) >= path.getmtime(fitsfile)):
+        cached = fits.getheader(outfile)
+        if (cached.get('OVRSCANX') == columns and
+            cached.get('OVRSCANY') == rows and
+            cached.get('AMPDIR') == ampdir):
+            return outfile
+    raw, scale = readimage(fitsfile)
+    image = subtractraw(raw, scale, columns, rows, ampdir, chunkbytes)
+    header = fits.getheader(fitsfile)
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    header['OVRSCANX'] = (columns, "Overscan columns of each amplifier")
+    header['OVRSCANY'] = (rows, "Overscan rows")
+    header['AMPDIR'] = (ampdir, "Amplifiers used")
+    header['BIASSUB'] = (True, "Overscan bias subtracted and trimmed")
+    hdulist = fits.HDUList([fits.PrimaryHDU(image, header=header)])
+    with fits.open(fitsfile, memmap=True) as source:
+        if 'VARIANCE' in source:
+            hdulist.append(fits.ImageHDU(
+                trim(source['VARIANCE'].data, columns, rows, ampdir),
+                name='VARIANCE'))
+        tmpname = outfile + '.tmp'
+        hdulist.writeto(tmpname, overwrite=True)
+    os.replace(tmpname, outfile)
+    return outfile
@@ -0,0 +1,321 @@
+import os
+import logging
+from collections import deque, OrderedDict
+from datetime import datetime
+from threading import Thread, Lock, BoundedSemaphore, Event
+from queue import Queue
+from ImageDB import ImageDB
+from Metadata import update_file_metadata
+from Metrics import Metrics
+from Render import makethumbnail
+from astropy.io import fits
+import Skipper
+import Overscan
+from CCDDAnalyze import analyze, getampdirection, shutdownpool
+path = os.path
+log = logging.getLogger(__name__)
+
+
+class PostJob(object):
+    """ Post-processing state of a single exposure """
+
+    def __init__(self, fitsfile, metadata=None, thumb=None, spectrum=None,
+                 timings=None, ccdconfig=None):
+        """
+        Args:
+          fitsfile (str): path to the freshly written fits file
+          metadata (dict): metadata to write to the file header before
+                           adding it to the database
+          thumb (str): where to write the png preview, or None to skip
+          spectrum (str): where to write the spectrum plot
+          timings (dict): durations (s) already measured for this image, 
+                          e.g. by the exposure loop. Stage durations are
+                          added and the result saved with the database entry
+          ccdconfig (str): contents of the CCDDrone ini file the image was
+                           taken with, to know how many skipper samples
+                           each pixel has
+        """
+        self.fitsfile = fitsfile
+        self.metadata = metadata
+        self.thumb = thumb
+        self.spectrum = spectrum
+        self.submitted = datetime.now()
+        self.stages = OrderedDict()
+        self.metrics = None
+        self.timings = dict(timings or {})
+        self.ccdconfig = ccdconfig
+        self.combined = None
+        self.corrected = None
+        self.done = Event()
+
+    @property
+    def imagefile(self):
+        """ The file to preview and analyze: the bias subtracted image if
+        there is one, then the combined image of skipper exposures, otherwise
+        the raw file
+        """
+        return self.corrected or self.combined or self.fitsfile
+
+    def todict(self):
+        """ Summarize the job for the status API """
+        return dict(filename=path.basename(self.fitsfile),
+                    submitted=str(self.submitted)[:-7],
+                    stages=dict(self.stages), metrics=self.metrics,
+                    timings=dict(self.timings))
+
+
+class PostProcessor(object):
+    """ Run the post-exposure stages (database ingest, skipper sample
+    combination, overscan subtraction, thumbnail, analysis)
+    in the background while the next exposure is being taken.
+
+    Stages run inside this process with their imports already loaded and a
+    shared database connection. Each stage has its own worker thread fed by
+    a queue, so files leave every stage in the order they were exposed. At
+    most `maxpending` files may be in flight; `submit` blocks beyond that,
+    which holds back the exposure loop rather than letting a backlog grow
+    without bound.
+    """
+
+    stages = ('ingest', 'combine', 'overscan', 'thumbnail', 'analysis')
+
+    def __init__(self, config=None, output=None, onchange=None, imagedb=None,
+                 metrics=None, **kwargs):
+        """
+        Args:
+          config (dict): dictionary of config settings. will be merged with
+                         any other provided kwargs. valid keys are:
+            PIPELINE_MAXPENDING (int): files in flight before submit blocks
+            PIPELINE_HISTORY (int): number of finished files to report
+            THUMBNAIL_REDUCE (int): downsampling factor of the preview
+            THUMBNAIL_PERCENT (float): percent of pixels inside the preview's
+                                       display range
+            THUMBNAIL_STRETCH (str): 'linear', 'sqrt', 'log' or 'asinh'
+            SKIPPER_COMBINE (str): 'mean' or 'median' of the samples of each
+                                   pixel of skipper images
+            SKIPPER_CHUNK_MB (float): raw samples to combine at once
+            OVERSCAN_COLUMNS (int): overscan columns of each amplifier, if
+                                    neither the header nor the CCDDrone
+                                    config say
+            OVERSCAN_ROWS (int): overscan rows, likewise
+            CLUSTER_HIGHENERGY (float): electrons above which a cluster
+                                        counts as high energy
+            ANALYSIS_WORKERS (int): processes fitting the amplifiers and
+                                    HDUs of an image. None for one per cpu,
+                                    1 to fit them in this process
+            IMAGEDB_URI (str): database to connect to if `imagedb` is None
+            IMAGEDB_COLLECTION (str): collection to use if `imagedb` is None
+          output (callable): called with each line of stage output
+          onchange (callable): called whenever a stage changes state
+          imagedb (ImageDB): connected database to add files to
+          metrics (Metrics): where to record stage durations and failures
+        """
+        config = config or {}
+        def getkey(key, default=None):
+            return kwargs.get(key, config.get(key, default))
+        self.imagedb = imagedb
+        self.imagedb_uri = getkey("IMAGEDB_URI", ImageDB.default_uri)
+        self.imagedb_collection = getkey("IMAGEDB_COLLECTION",
+                                         ImageDB.default_collection)
+        self.output = output or (lambda line: log.info(line))
+        self.onchange = onchange or (lambda: None)
+        self.metrics = metrics or Metrics()
+        self.maxpending = getkey('PIPELINE_MAXPENDING', 4)
+        self.history = deque(maxlen=getkey('PIPELINE_HISTORY', 10))
+        self.thumbnailopts = dict(reduce=getkey('THUMBNAIL_REDUCE', 2),
+                                  percent=getkey('THUMBNAIL_PERCENT', 98),
+                                  stretch=getkey('THUMBNAIL_STRETCH', 
+                                                 'linear'))
+        self.combinemethod = getkey('SKIPPER_COMBINE', 'mean')
+        self.combinechunk = int(getkey('SKIPPER_CHUNK_MB', 64)*1024*1024)
+        self.overscansize = (getkey('OVERSCAN_COLUMNS', 0),
+                             getkey('OVERSCAN_ROWS', 0))
+        self.analysisworkers = getkey('ANALYSIS_WORKERS')
+        self.highenergy = getkey('CLUSTER_HIGHENERGY', 1000)
+        self._slots = BoundedSemaphore(self.maxpending)
+        self._lock = Lock()
+        self.active = []
+        self._queues = [Queue() for stage in self.stages]
+        for index, stage in enumerate(self.stages):
+            Thread(target=self._work, args=(index,), daemon=True,
+                   name=f"PostProcessor-{stage}").start()
+
+    def submit(self, job):
+        """ Queue `job` for post-processing, waiting for a free slot.
+        Returns `job`; wait on `job.done` to know when every stage ran
+        """
+        with self.metrics.timer('pipeline_wait_seconds', 
+                                timings=job.timings, timingkey='wait'):
+            if not self._slots.acquire(blocking=False):
+                log.warning("Post-processing backlog full, waiting for %s",
+                            path.basename(job.fitsfile))
+                self._slots.acquire()
+        self.metrics.inc('images_total')
+        with self._lock:
+            for stage in self.stages:
+                job.stages[stage] = 'pending'
+            self.active.append(job)
+        self._queues[0].put(job)
+        self.onchange()
+        return job
+
+    def pending(self):
+        """ Number of files that have not finished every stage """
+        with self._lock:
+            return len(self.active)
+
+    def collectmetrics(self):
+        """ Record the current queue depths as gauges """
+        self.metrics.set('pipeline_pending', self.pending())
+        for stage, queue in zip(self.stages, self._queues):
+            self.metrics.set('pipeline_stage_queue', queue.qsize(), 
+                             {'stage': stage})
+
+    def getstatus(self):
+        """ Get the state of active and recently finished jobs """
+        with self._lock:
+            return dict(pending=len(self.active), maxpending=self.maxpending,
+                        jobs=[job.todict() for job in
+                              list(self.history) + self.active])
+
+    def shutdown(self):
+        """ Stop the analysis worker processes """
+        shutdownpool()
+
+    def _setstage(self, job, stage, state):
+        with self._lock:
+            job.stages[stage] = state
+        self.onchange()
+
+    def _work(self, index):
+        stage = self.stages[index]
+        runner = getattr(self, stage)
+        while True:
+            job = self._queues[index].get()
+            self._setstage(job, stage, 'running')
+            self.output(f"Running {stage} of {path.basename(job.fitsfile)}")
+            try:
+                with self.metrics.timer('pipeline_stage_seconds', 
+                                        {'stage': stage}, job.timings, stage):
+                    runner(job)
+                self._setstage(job, stage, 'done')
+            except Exception as e:
+                log.exception("Stage %s failed for %s", stage, job.fitsfile)
+                self.output(f"{stage} of {path.basename(job.fitsfile)} "
+                            f"failed: {e}")
+                self.metrics.inc('pipeline_stage_failures_total', 
+                                 {'stage': stage})
+                self._setstage(job, stage, 'failed')
+            if index + 1 < len(self.stages):
+                self._queues[index+1].put(job)
+            else:
+                self._savetimings(job)
+                self._finish(job)
+
+    def _savetimings(self, job):
+        """ Store the durations measured for `job` with its database entry """
+        if job.stages.get('ingest') != 'done':
+            return
+        try:
+            self.getimagedb().update(job.fitsfile, {'timing': job.timings})
+        except Exception:
+            log.exception("Unable to save timing of %s", job.fitsfile)
+
+    def _finish(self, job):
+        with self._lock:
+            self.active.remove(job)
+            self.history.append(job)
+        self._slots.release()
+        job.done.set()
+        self.onchange()
+
+    def getimagedb(self):
+        """ Get the database, connecting on first use """
+        if self.imagedb is None:
+            self.imagedb = ImageDB(self.imagedb_uri, self.imagedb_collection)
+        return self.imagedb
+
+    # the stages themselves
+    def ingest(self, job):
+        """ Write the metadata to the file and add it to the database """
+        if job.metadata:
+            update_file_metadata(job.fitsfile, dict(job.metadata),
+                                 validate=False)
+        imagedb = self.getimagedb()
+        imagedb.insert(job.fitsfile, update=True)
+        # shutter and readout times as recorded by CCDDExpose
+        entry = imagedb.find_one({'filename': path.basename(job.fitsfile)})
+        if not entry:
+            log.warning("No database entry for %s to read timings from",
+                        path.basename(job.fitsfile))
+            return
+        for name, start, stop in (('exposure', 'EXPSTART', 'EXPSTOP'),
+                                  ('readout', 'RDSTART', 'RDEND')):
+            if (isinstance(entry.get(start), datetime) and 
+                isinstance(entry.get(stop), datetime)):
+                seconds = (entry[stop] - entry[start]).total_seconds()
+                job.timings[name] = seconds
+                self.metrics.observe(name+'_seconds', seconds)
+
+    def combine(self, job):
+        """ Combine the samples of skipper images into one value per pixel
+        and a variance, written next to the raw file
+        """
+        ndcm = Skipper.getndcm(fits.getheader(job.fitsfile), job.ccdconfig)
+        if ndcm <= 1:
+            return
+        job.combined = Skipper.combine(job.fitsfile, ndcm,
+                                       method=self.combinemethod,
+                                       chunkbytes=self.combinechunk)
+        if job.stages.get('ingest') == 'done':
+            self.getimagedb().update(job.fitsfile,
+                                     {'NDCM': ndcm, 
+                                      'combinedpath': job.combined})
+
+    def overscan(self, job):
+        """ Subtract the bias measured in the overscan and trim it off,
+        written next to the raw file
+        """
+        header = fits.getheader(job.imagefile)
+        if header.get('BIASSUB'):
+            return
+        columns, rows = Overscan.getoverscan(header, job.ccdconfig,
+                                             *self.overscansize)
+        if not (columns or rows):
+            return
+        job.corrected = Overscan.correct(
+            job.imagefile, columns, rows,
+            ampdir=getampdirection(header, job.ccdconfig))
+        if job.stages.get('ingest') == 'done':
+            self.getimagedb().update(job.fitsfile,
+                                     {'correctedpath': job.corrected})
+
+    def thumbnail(self, job):
+        """ Render the png preview of the file """
+        if job.thumb:
+            makethumbnail(job.imagefile, job.thumb, **self.thumbnailopts)
+
+    def analysis(self, job):
+        """ Fit the pixel distribution and plot the spectrum """
+        steps = {}
+        try:
+            clusterfile = path.splitext(job.fitsfile)[0] + '_clusters.fits'
+            job.metrics = analyze(job.imagefile, job.spectrum, 
+                                  output=self.output, timings=steps,
+                                  ccdconfig=job.ccdconfig,
+                                  workers=self.analysisworkers,
+                                  clusterfile=clusterfile,
+                                  highenergy=self.highenergy)
+            if job.stages.get('ingest') == 'done':
+                # the cluster summary is kept at the top level for queries
+                analysis = dict(job.metrics)
+                self.getimagedb().update(job.fitsfile, 
+                                         {'clusters': analysis.pop('clusters'),
+                                          'clusterpath': clusterfile,
+                                          'analysis': analysis})
+        finally:
+            for step, seconds in steps.items():
+                self.metrics.observe('analysis_step_seconds', seconds, 
+                                     {'step': step})
+            job.timings.update({'analysis_'+step: seconds 
+                                for step, seconds in steps.items()})
@@ -0,0 +1,137 @@
+""" Read rectangular regions and profiles out of fits images without loading
+the whole file
+"""
+import io
+import numpy as np
+from Render import readimage
+
+# ways to combine pixels into a profile. mean and sum are accumulated a
+# chunk of rows at a time, the others need the whole region in memory
+profilestats = {
+    'mean': None,
+    'sum': None,
+    'median': np.median,
+    'std': np.std,
+}
+
+
+def getregion(shape, x0=None, x1=None, y0=None, y1=None):
+    """ Clip a requested box to an image of `shape`
+    Args:
+      shape (tuple): (rows, columns) of the image
+      x0, x1, y0, y1 (int): first and one past the last column and row.
+                            Missing values extend to the image edge
+    Returns:
+      region (tuple): (x0, x1, y0, y1)
+    Raises:
+      ValueError if the box is empty
+    """
+    ny, nx = shape
+    x0 = max(0, x0 or 0)
+    y0 = max(0, y0 or 0)
+    x1 = nx if x1 is None else min(nx, x1)
+    y1 = ny if y1 is None else min(ny, y1)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"Empty region x=[{x0},{x1}) y=[{y0},{y1}) in "
+                         f"image of {nx}x{ny}")
+    return x0, x1, y0, y1
+
+
+def applyscale(raw, scale):
+    """ Convert raw stored values to physical ones in a native dtype,
+    keeping integers as integers when BSCALE is 1
+    """
+    bscale, bzero = scale
+    if raw.dtype.kind in 'iu' and bscale == 1 and float(bzero).is_integer():
+        if raw.dtype.itemsize == 2 and bzero == 32768:
+            # the standard way of storing unsigned 16 bit data
+            return (raw.astype(np.int32) + 32768).astype(np.uint16)
+        dtype = np.int32 if raw.dtype.itemsize <= 2 else np.int64
+        data = raw.astype(dtype)
+        if bzero:
+            data += int(bzero)
+        return data
+    dtype = np.float32 if raw.dtype.itemsize <= 4 else np.float64
+    data = raw.astype(dtype)
+    if (bscale, bzero) != (1, 0):
+        data *= bscale
+        data += bzero
+    return data
+
+
+def readregion(fitsfile, hdu=0, maxpixels=None, **box):
+    """ Read part of an image through a memory map
+    Args:
+      fitsfile (str): path to the fits file
+      hdu (int): which HDU holds the image
+      maxpixels (int): refuse regions bigger than this
+      box: x0, x1, y0, y1 as for `getregion`
+    Returns:
+      data (ndarray): the pixels, with data[0, 0] at (x0, y0)
+      region (tuple): (x0, x1, y0, y1) actually read
+    """
+    raw, scale = readimage(fitsfile, hdu)
+    x0, x1, y0, y1 = region = getregion(raw.shape, **box)
+    if maxpixels and (x1 - x0) * (y1 - y0) > maxpixels:
+        raise ValueError(f"Region of {x1-x0}x{y1-y0} pixels is larger than "
+                         f"the limit of {maxpixels}")
+    return applyscale(raw[y0:y1, x0:x1], scale), region
+
+
+def readprofile(fitsfile, axis='x', stat='mean', hdu=0, maxpixels=None,
+                chunkrows=256, **box):
+    """ Project part of an image onto one axis
+    Args:
+      fitsfile (str): path to the fits file
+      axis (str): 'x' for one value per column, 'y' for one per row
+      stat (str): one of `profilestats`, how to combine the pixels
+      hdu (int): which HDU holds the image
+      maxpixels (int): for stats which need the whole region in memory,
+                       refuse regions bigger than this
+      chunkrows (int): rows to read at a time for mean and sum
+      box: x0, x1, y0, y1 as for `getregion`
+    Returns:
+      profile (ndarray): float64 values along `axis`
+      region (tuple): (x0, x1, y0, y1) actually read
+    """
+    if axis not in ('x', 'y'):
+        raise ValueError(f"axis must be 'x' or 'y', not '{axis}'")
+    if stat not in profilestats:
+        raise ValueError(f"Unknown stat '{stat}', expected one of "
+                         f"{', '.join(profilestats)}")
+    npaxis = 0 if axis == 'x' else 1
+    if profilestats[stat] is not None:
+        data, region = readregion(fitsfile, hdu, maxpixels, **box)
+        data = data.astype(np.float64, copy=False)
+        return profilestats[stat](data, axis=npaxis), region
+
+    raw, scale = readimage(fitsfile, hdu)
+    x0, x1, y0, y1 = region = getregion(raw.shape, **box)
+    # only `chunkrows` rows are ever converted at once
+    if axis == 'x':
+        profile = np.zeros(x1 - x0)
+    else:
+        profile = np.empty(y1 - y0)
+    for start in range(y0, y1, chunkrows):
+        stop = min(y1, start + chunkrows)
+        chunk = applyscale(raw[start:stop, x0:x1], scale)
+        if axis == 'x':
+            profile += chunk.sum(axis=0, dtype=np.float64)
+        else:
+            profile[start-y0:stop-y0] = chunk.sum(axis=1, dtype=np.float64)
+    if stat == 'mean':
+        profile /= (y1 - y0) if axis == 'x' else (x1 - x0)
+    return profile, region
+
+
+def tonpy(data):
+    """ Serialize an array in numpy's .npy format """
+    output = io.BytesIO()
+    np.save(output, data, allow_pickle=False)
+    return output.getvalue()
+
+
+def toraw(data):
+    """ Little-endian bytes of an array, for javascript typed arrays """
+    return np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('<'))\
+             .tobytes()
@@ -0,0 +1,164 @@
+""" Render fits images to 8-bit PNG with numpy, for thumbnails and the
+database browser
+"""
+import io
+import os
+import numpy as np
+from astropy.io import fits
+from PIL import Image
+path = os.path
+
+# map values scaled to [0, 1] onto the display range, as astropy's stretches
+stretches = {
+    'linear': lambda x: x,
+    'sqrt': np.sqrt,
+    'log': lambda x: np.log1p(1000 * x) / np.log(1001),
+    'asinh': lambda x: np.arcsinh(x / 0.1) / np.arcsinh(10),
+}
+
+
+def readimage(fitsfile, hdu=0):
+    """ Get the image in `fitsfile` as a memory map where possible
+    Returns:
+      data (ndarray): the raw stored values; apply `scale` to get real ones
+      scale (tuple): (bscale, bzero) from the header
+    """
+    # scaled images would be read completely into memory by astropy, so
+    # read the raw values and scale only what we use
+    with fits.open(fitsfile, memmap=True, do_not_scale_image_data=True,
+                   mode='readonly') as hdulist:
+        header = hdulist[hdu].header
+        data = hdulist[hdu].data
+        scale = (header.get('BSCALE', 1), header.get('BZERO', 0))
+    if data is None:
+        raise ValueError(f"No image data in {fitsfile}")
+    # render the first plane of data cubes
+    while data.ndim > 2:
+        data = data[0]
+    return data, scale
+
+
+def blockmean(data, factor):
+    """ Downsample a 2D image by averaging `factor` x `factor` blocks.
+    Rows and columns that don't fill a whole block are dropped.
+    """
+    if factor <= 1:
+        return np.array(data, dtype=np.float32)
+    ny = data.shape[0] // factor
+    nx = data.shape[1] // factor
+    data = data[:ny*factor, :nx*factor]
+    if factor > 4:
+        blocks = data.reshape(ny, factor, nx, factor)
+        return blocks.mean(axis=(1, 3), dtype=np.float32)
+    # for small blocks, adding strided views is much faster than a mean
+    # over a reshaped array
+    total = np.zeros((ny, nx), dtype=np.float32)
+    for row in range(factor):
+        for col in range(factor):
+            total += data[row::factor, col::factor]
+    total *= 1 / factor**2
+    return total
+
+
+def cutlevels(data, percent=98, maxsamples=1000000, maxbins=1 << 24):
+    """ Get the values which clip (100-`percent`)/2 % of the pixels at each
+    end. These are the pixel values at those ranks, as astropy's
+    PercentileInterval gives without interpolating between pixels.
+    Integer images are counted exactly, a block of rows at a time. Float
+    images, and integer ones with more than `maxbins` distinct possible
+    values, are sorted instead; bigger than `maxsamples` pixels, only a
+    regular grid of about that many is, so their levels are approximate
+    Args:
+      maxsamples (int): pixels to sort at most
+      maxbins (int): largest range of integer values to count
+    """
+    lowfrac = (100 - percent) / 200
+    if np.issubdtype(data.dtype, np.integer) and data.size:
+        offset = int(data.min())
+        nbins = int(data.max()) - offset + 1
+        if nbins <= maxbins:
+            counts = np.zeros(nbins, dtype=np.int64)
+            rows = max(1, maxsamples // max(1, data[0].size))
+            for start in range(0, data.shape[0], rows):
+                chunk = data[start:start+rows].astype(np.int64) - offset
+                counts += np.bincount(chunk.ravel(), minlength=nbins)
+            cumulative = np.cumsum(counts)
+            # the value at sorted position k is the first one with more
+            # than k pixels at or below it
+            low = int(lowfrac * (data.size - 1))
+            high = int((1 - lowfrac) * (data.size - 1))
+            low, high = np.searchsorted(cumulative, (low, high), side='right')
+            return float(low + offset), float(high + offset)
+
+    step = max(1, int(np.sqrt(data.size / maxsamples)))
+    values = np.asarray(data[::step, ::step], dtype=np.float32)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return 0., 1.
+    low = int(lowfrac * (values.size - 1))
+    high = int((1 - lowfrac) * (values.size - 1))
+    values = np.partition(values, (low, high))
+    return float(values[low]), float(values[high])
+
+
+def renderimage(fitsfile, reduce=1, percent=98, stretch='linear', hdu=0):
+    """ Render a fits image to an 8-bit grayscale PIL image
+    Args:
+      fitsfile (str): path to the fits file
+      reduce (int): downsample by averaging blocks of this size
+      percent (float): percentage of pixels inside the display range
+      stretch (str): one of `stretches`
+      hdu (int): which HDU holds the image
+    Returns:
+      image (PIL.Image): with the first row of the data at the bottom,
+                         as fits2bitmap and ds9 show it
+    """
+    if stretch not in stretches:
+        raise ValueError(f"Unknown stretch '{stretch}', expected one of "
+                         f"{', '.join(stretches)}")
+    raw, scale = readimage(fitsfile, hdu)
+    # levels from the full resolution image, so noise looks the same at
+    # every scale
+    low, high = cutlevels(raw, percent)
+    data = blockmean(raw, int(reduce))
+    pixels = topixels(data, low, high, stretch, scale)
+    return Image.fromarray(pixels[::-1], mode='L')
+
+
+def topixels(data, low, high, stretch='linear', scale=(1, 0)):
+    """ Map raw values to 8-bit gray levels
+    Args:
+      data (ndarray): float32 raw values, modified in place
+      low, high (float): raw values shown as black and white
+      stretch (str): one of `stretches`
+      scale (tuple): (bscale, bzero) of the raw values, as `readimage`
+    """
+    bscale, bzero = scale
+    if (bscale, bzero) != (1, 0):
+        low, high = low * bscale + bzero, high * bscale + bzero
+        data *= bscale
+        data += bzero
+    data -= low
+    data *= 1 / ((high - low) or 1)
+    np.clip(data, 0, 1, out=data)
+    data = stretches[stretch](data)
+    return np.nan_to_num(data * 255, nan=0).astype(np.uint8)
+
+
+def renderpng(fitsfile, **kwargs):
+    """ Render `fitsfile` as with `renderimage` and return the png bytes """
+    output = io.BytesIO()
+    renderimage(fitsfile, **kwargs).save(output, format='png',
+                                         compress_level=1)
+    return output.getvalue()
+
+
+def makethumbnail(fitsfile, thumb, reduce=2, **kwargs):
+    """ Render `fitsfile` to the png `thumb`, shrunk by a factor `reduce`
+    The file is written next to `thumb` and renamed, so viewers never see a
+    partial image. Other arguments are passed to `renderimage`
+    """
+    scaled = thumb + '.tmp.png'
+    renderimage(fitsfile, reduce=reduce, **kwargs).save(scaled,
+                                                        compress_level=1)
+    os.replace(scaled, thumb)
@@ -0,0 +1,195 @@
+""" Sequence plans: declarative descriptions of data taking campaigns that
+compile to Executor queue jobs. See `example_plan` for the format.
+
+Steps are either commands (`do`) or groups. A `foreach` group runs its steps
+once for every combination of the listed values, which can be referenced as
+`$name` or `${name}` in any string parameter. A `repeat` group runs its
+steps N times. `metadata` on the plan or on an expose step is merged over
+the metadata of the last exposure.
+"""
+import json
+from itertools import product
+from string import Template
+from Metadata import validate_metadata
+
+# short names for the queueable Executor commands, and their parameters
+commands = {
+    'startup': ('StartupAndErase', ()),
+    'erase': ('PerformEraseProcedure', ()),
+    'apply': ('ApplyNewSettings', ()),
+    'bias': ('ToggleBias', ('value',)),
+    'expose': ('ExposeLoop', ('exposure', 'nexposures', 'filename',
+                              'metadata')),
+}
+
+example_plan = """{
+  "name": "dark sweep",
+  "metadata": {"RUNTYPE": "background", "NOTES": "dark current sweep"},
+  "steps": [
+    {"do": "startup"},
+    {"do": "bias", "value": "on"},
+    {"foreach": {"exposure": [1, 10, 100, 1000]},
+     "steps": [
+       {"do": "erase"},
+       {"do": "expose", "exposure": "$exposure", "nexposures": 2,
+        "filename": "Dark_${exposure}s"}
+     ]},
+    {"repeat": 2, "steps": [{"do": "erase"}]}
+  ]
+}
+"""
+
+# rough duration (s) of each command, used when not given in the config
+default_durations = {
+    'StartupAndErase': 30,
+    'PerformEraseProcedure': 20,
+    'ApplyNewSettings': 5,
+    'ToggleBias': 1,
+    'readout': 100,
+}
+
+
+def parse_plan(plan):
+    """ Load a plan from a JSON string, or pass through a parsed plan """
+    if isinstance(plan, (str, bytes)):
+        try:
+            plan = json.loads(plan)
+        except ValueError as e:
+            raise ValueError(f"Plan is not valid JSON: {e}")
+    if not isinstance(plan, dict) or not isinstance(plan.get('steps'), list):
+        raise ValueError("Plan must be an object with a 'steps' list")
+    return plan
+
+
+def _substitute(value, variables):
+    """ Replace $name references in `value` by loop variables """
+    if isinstance(value, str):
+        # a bare reference keeps the type of the variable
+        if value.startswith('$') and value.strip('${}') in variables:
+            return variables[value.strip('${}')]
+        try:
+            return Template(value).substitute(variables)
+        except KeyError as e:
+            raise ValueError(f"Unknown variable {e} in '{value}'")
+        except ValueError:
+            raise ValueError(f"Bad variable reference in '{value}', "
+                             "use $$ for a literal $")
+    elif isinstance(value, dict):
+        return {key: _substitute(val, variables)
+                for key, val in value.items()}
+    elif isinstance(value, list):
+        return [_substitute(val, variables) for val in value]
+    return value
+
+
+def _compile_steps(steps, variables, metadata, where):
+    for index, step in enumerate(steps):
+        here = f"{where}[{index}]"
+        if not isinstance(step, dict):
+            raise ValueError(f"{here}: step must be an object")
+        if 'foreach' in step:
+            loops = step['foreach']
+            if not isinstance(loops, dict) or not all(
+                    isinstance(vals, list) for vals in loops.values()):
+                raise ValueError(f"{here}: 'foreach' must map names to lists")
+            names = list(loops)
+            for values in product(*(loops[name] for name in names)):
+                inner = dict(variables, **dict(zip(names, values)))
+                yield from _compile_steps(step.get('steps', []), inner,
+                                          metadata, here+'.steps')
+        elif 'repeat' in step:
+            if not isinstance(step['repeat'], int) or step['repeat'] < 0:
+                raise ValueError(f"{here}: 'repeat' must be a count")
+            for i in range(step['repeat']):
+                yield from _compile_steps(step.get('steps', []), variables,
+                                          metadata, here+'.steps')
+        elif 'do' in step:
+            yield _compile_command(step, variables, metadata, here)
+        else:
+            raise ValueError(f"{here}: need one of 'do', 'foreach', 'repeat'")
+
+
+def _wholenumber(value, name):
+    """ `value` as an int, refusing fractions rather than truncating them """
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+    if isinstance(value, bool) or number is None or not number.is_integer():
+        raise ValueError(f"{name} must be a whole number, not {value!r}")
+    return int(number)
+
+
+def _compile_command(step, variables, metadata, where):
+    step = _substitute(step, variables)
+    name = step.pop('do')
+    if name not in commands:
+        raise ValueError(f"{where}: unknown command '{name}', expected one "
+                         f"of {', '.join(commands)}")
+    cmd, allowed = commands[name]
+    unknown = set(step) - set(allowed)
+    if unknown:
+        raise ValueError(f"{where}: '{name}' does not take "
+                         f"{', '.join(sorted(unknown))}")
+    if cmd == 'ToggleBias':
+        if step.get('value') not in ('on', 'off'):
+            raise ValueError(f"{where}: bias value must be 'on' or 'off'")
+        return cmd, dict(value=step['value'])
+    elif cmd == 'ExposeLoop':
+        stepmeta = dict(metadata, **step.get('metadata', {}))
+        try:
+            validate_metadata(stepmeta)
+            kwargs = dict(seconds=_wholenumber(step.get('exposure', 5),
+                                               'exposure'),
+                          nexposures=_wholenumber(step.get('nexposures', 1),
+                                                  'nexposures'),
+                          fitsfile=str(step.get('filename', 'Image')),
+                          metadata=stepmeta)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"{where}: {e}")
+        if kwargs['seconds'] < 0 or kwargs['nexposures'] < 1:
+            raise ValueError(f"{where}: invalid exposure settings")
+        return cmd, kwargs
+    return cmd, {}
+
+
+def compile_plan(plan, metadata=None):
+    """ Expand a plan into a flat list of Executor jobs
+    Args:
+      plan (dict or str): the plan, see module documentation
+      metadata (dict): default metadata for exposures. The plan's and each
+                       step's `metadata` are merged on top of it
+    Returns:
+      steps (list): (cmd, kwargs) tuples to pass to `Executor.enqueue`
+    Raises:
+      ValueError if the plan is malformed
+    """
+    plan = parse_plan(plan)
+    metadata = dict(metadata or {}, **plan.get('metadata', {}))
+    return list(_compile_steps(plan['steps'], {}, metadata, 'steps'))
+
+
+def estimate_duration(steps, durations=None):
+    """ Estimate how long (s) the compiled `steps` take to run
+    Args:
+      steps (list): output of `compile_plan`
+      durations (dict): seconds per command name, and 'readout' for the
+                        time to read out one image, overriding the defaults
+    """
+    durations = dict(default_durations, **(durations or {}))
+    total = 0
+    for cmd, kwargs in steps:
+        if cmd == 'ExposeLoop':
+            total += kwargs['nexposures'] * (kwargs['seconds'] +
+                                             durations['readout'])
+        else:
+            total += durations.get(cmd, 0)
+    return total
+
+
+def format_duration(seconds):
+    """ Format a duration in seconds as e.g. '2 h 05 min' """
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return f"{minutes} min" if minutes else f"{int(seconds)} s"
+    return f"{minutes // 60} h {minutes % 60:02d} min"
@@ -0,0 +1,98 @@
+""" Combine the repeated charge measurements of skipper CCD images """
+import os
+import configparser
+import numpy as np
+from astropy.io import fits
+from Render import readimage
+from Regions import applyscale
+path = os.path
+
+# how the samples of each pixel may be combined
+combiners = ('mean', 'median')
+
+
+def getndcm(header, ccdconfig=None):
+    """ Number of charge measurements per pixel of an image
+    Args:
+      header (fits.Header): header of the raw image. An NDCM keyword wins
+      ccdconfig (str): contents of the CCDDrone ini file the image was
+                       taken with, used when the header doesn't say
+    Returns:
+      ndcm (int): 1 for images that are not skipper images
+    """
+    if 'NDCM' in header:
+        return max(1, int(header['NDCM']))
+    if not ccdconfig:
+        return 1
+    parser = configparser.ConfigParser(inline_comment_prefixes=(';',))
+    try:
+        parser.read_string(ccdconfig)
+        ccd = parser['ccd']
+        if ccd.get('type', '').strip().upper() != 'SK':
+            return 1
+        return max(1, ccd.getint('NDCM', 1))
+    except (configparser.Error, KeyError, ValueError):
+        return 1
+
+
+def combinedpath(fitsfile):
+    """ Where the combined image of `fitsfile` is written """
+    root, ext = path.splitext(fitsfile)
+    return f"{root}_combined{ext}"
+
+
+def combine(fitsfile, ndcm, outfile=None, method='mean', hdu=0,
+            chunkbytes=64*1024*1024):
+    """ Combine the samples of a raw skipper image
+    The raw image holds the `ndcm` samples of each pixel next to each other
+    along its rows, so it is `ndcm` times wider than the CCD. It is read
+    through a memory map a block of rows at a time, so only one block of
+    samples is in memory at once.
+    Args:
+      fitsfile (str): path to the raw fits file
+      ndcm (int): number of samples per pixel
+      outfile (str): where to write the result, default `combinedpath`
+      method (str): 'mean' or 'median' of the samples of each pixel
+      hdu (int): which HDU holds the raw image
+      chunkbytes (int): approximate size of each block of raw samples
+    Returns:
+      outfile (str): the written file. Its primary HDU holds the combined
+                     image and a VARIANCE extension the sample variance of
+                     each pixel
+    """
+    if method not in combiners:
+        raise ValueError(f"Unknown combine method '{method}', expected one "
+                         f"of {', '.join(combiners)}")
+    raw, scale = readimage(fitsfile, hdu)
+    rows, width = raw.shape
+    if ndcm < 1 or width % ndcm:
+        raise ValueError(f"Image width {width} is not a multiple of "
+                         f"NDCM={ndcm}")
+    columns = width // ndcm
+    combined = np.empty((rows, columns), dtype=np.float32)
+    variance = np.zeros((rows, columns), dtype=np.float32)
+    chunkrows = max(1, chunkbytes // (width * 8))
+    for start in range(0, rows, chunkrows):
+        stop = min(rows, start + chunkrows)
+        samples = applyscale(raw[start:stop], scale).astype(np.float64)
+        samples = samples.reshape(stop - start, columns, ndcm)
+        if method == 'mean':
+            combined[start:stop] = samples.mean(axis=2)
+        else:
+            combined[start:stop] = np.median(samples, axis=2)
+        if ndcm > 1:
+            variance[start:stop] = samples.var(axis=2, ddof=1)
+
+    header = fits.getheader(fitsfile, hdu)
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        header.remove(key, ignore_missing=True)
+    header['NDCM'] = (ndcm, "Charge measurements per pixel of the raw image")
+    header['COMBINE'] = (method, "How the measurements were combined")
+    header['RAWFILE'] = (path.basename(fitsfile), "Raw skipper image")
+    outfile = outfile or combinedpath(fitsfile)
+    tmpname = outfile + '.tmp'
+    fits.HDUList([fits.PrimaryHDU(combined, header=header),
+                  fits.ImageHDU(variance, name='VARIANCE')]
+                 ).writeto(tmpname, overwrite=True)
+    os.replace(tmpname, outfile)
+    return outfile
@@ -0,0 +1,133 @@
+""" Deep-zoom style tile pyramids of fits images, rendered on demand and
+cached on disk
+"""
+import os
+import json
+import math
+import shutil
+import hashlib
+import logging
+from glob import glob, escape
+from threading import get_ident
+import numpy as np
+from PIL import Image
+from Render import readimage, cutlevels, blockmean, topixels, stretches
+path = os.path
+log = logging.getLogger(__name__)
+
+
+class TilePyramid(object):
+    """ Serve any part of an image at any power of two zoom out.
+
+    Levels follow the Deep Zoom convention: the highest level is the full
+    resolution image, and each level below it is half the size, down to a
+    single pixel at level 0. Each level is cut into `tilesize` square tiles,
+    numbered by column and row from the top left. Tiles are rendered the
+    first time they are asked for, reading only the part of the memory
+    mapped file they cover, and kept on disk until the file changes.
+    """
+
+    def __init__(self, cachedir, tilesize=256, percent=98, stretch='linear'):
+        """
+        Args:
+          cachedir (str): directory to keep rendered tiles in
+          tilesize (int): width and height of tiles in pixels
+          percent (float): percent of pixels inside the display range
+          stretch (str): one of `Render.stretches`
+        """
+        if stretch not in stretches:
+            raise ValueError(f"Unknown stretch '{stretch}'")
+        self.cachedir = cachedir
+        self.tilesize = tilesize
+        self.percent = percent
+        self.stretch = stretch
+
+    def _pyramiddir(self, fitsfile):
+        """ Directory for the current version of `fitsfile` """
+        stat = os.stat(fitsfile)
+        key = repr((path.abspath(fitsfile), stat.st_mtime_ns, stat.st_size,
+                    self.tilesize, self.percent, self.stretch))
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return path.join(self.cachedir,
+                         f"{path.basename(fitsfile)}-{digest}")
+
+    def info(self, fitsfile):
+        """ Get the size, levels and display range of `fitsfile`, creating
+        its cache directory if needed
+        """
+        pyramid = self._pyramiddir(fitsfile)
+        infofile = path.join(pyramid, 'info.json')
+        try:
+            with open(infofile) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+        # drop tiles of older versions of the file
+        for old in glob(path.join(self.cachedir,
+                                  escape(path.basename(fitsfile)) + '-*')):
+            if old != pyramid:
+                shutil.rmtree(old, ignore_errors=True)
+        os.makedirs(pyramid, exist_ok=True)
+
+        raw, scale = readimage(fitsfile)
+        height, width = raw.shape
+        low, high = cutlevels(raw, self.percent)
+        info = dict(width=width, height=height, tilesize=self.tilesize,
+                    maxlevel=math.ceil(math.log2(max(width, height, 1))),
+                    low=low, high=high, scale=scale,
+                    version=path.basename(pyramid).rsplit('-', 1)[1])
+        tmpname = infofile + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmpname, infofile)
+        return info
+
+    def tile(self, fitsfile, level, col, row):
+        """ Get the path to a rendered tile, rendering it if needed
+        Raises:
+          ValueError if the tile is outside the image
+        """
+        info = self.info(fitsfile)
+        if not 0 <= level <= info['maxlevel']:
+            raise ValueError(f"No level {level}")
+        factor = 2 ** (info['maxlevel'] - level)
+        span = self.tilesize * factor
+        # display rows count from the top, the first data row is at bottom
+        x0, y0 = col * span, row * span
+        if not (0 <= x0 < info['width'] and 0 <= y0 < info['height']):
+            raise ValueError(f"No tile {col}, {row} at level {level}")
+
+        tilefile = path.join(self._pyramiddir(fitsfile), str(level),
+                             f"{col}_{row}.png")
+        if path.isfile(tilefile):
+            return tilefile
+
+        raw, scale = readimage(fitsfile)
+        height = info['height']
+        x1 = min(x0 + span, info['width'])
+        y1 = min(y0 + span, height)
+        region = raw[height-y1:height-y0, x0:x1][::-1]
+        # pad partial blocks at the border with zeros, which add nothing to
+        # the block sums, then average over the pixels really there
+        nrows, ncols = region.shape
+        padrows = -nrows % factor
+        padcols = -ncols % factor
+        if padrows or padcols:
+            region = np.pad(region, ((0, padrows), (0, padcols)))
+        data = blockmean(region, factor)
+        if padrows or padcols:
+            rowcounts = np.minimum(factor,
+                                   nrows - factor*np.arange(data.shape[0]))
+            colcounts = np.minimum(factor,
+                                   ncols - factor*np.arange(data.shape[1]))
+            data *= factor**2 / np.outer(rowcounts, colcounts)
+        pixels = topixels(data, info['low'], info['high'], self.stretch,
+                          tuple(info['scale']))
+        os.makedirs(path.dirname(tilefile), exist_ok=True)
+        tmpname = tilefile + f".{os.getpid()}-{get_ident()}.tmp"
+        Image.fromarray(pixels, mode='L').save(tmpname, format='png',
+                                               compress_level=1)
+        os.replace(tmpname, tilefile)
+        return tilefile
+
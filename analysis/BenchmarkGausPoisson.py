@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+    Times the gaussian convolved with poisson model and the fit that uses it, and checks the vectorized model and
+    analytic jacobian against the original per-k loop and finite differences.
+
+    Use:
+        python analysis/BenchmarkGausPoisson.py [npoisson]
+"""
+import sys
+import timeit
+import numpy as np
+import lmfit
+from scipy.special import factorial
+import PoissonGausFit as poisgaus
+
+
+def loopGausPoisson(x, *par):
+    """
+        The original implementation of fGausPoisson, one python iteration per k
+    """
+    sigma, lamb, offset, a, N, npoiss = par[:6]
+    y = 0
+    for k in range(int(npoiss)):
+        y += ( lamb**k * np.exp(-lamb) / factorial(k) * np.exp( - (a*k - (x - offset))**2 / (2 * sigma**2)) )
+    return y * N / np.sqrt(2 * np.pi * sigma**2)
+
+
+def fakeHistogram(par, nbins=200, seed=0):
+    """
+        Poisson noise on the model, binned like DamicImage with minRange=200
+    """
+    centers = np.arange(par[2] - nbins // 4, par[2] + 3 * nbins // 4) + 0.5
+    rng = np.random.default_rng(seed)
+    return centers, rng.poisson(poisgaus.fGausPoisson(centers, *par)).astype(float)
+
+
+def fit(centers, hpix, npoisson, jacobian):
+    """
+        Fit as computeGausPoissDist does, with or without the analytic jacobian
+    """
+    params = lmfit.Parameters()
+    params.add("sigma", value=np.std(np.repeat(centers, hpix.astype(int))) / 2)
+    params.add("lamb", value=0.5, min=0)
+    params.add("offset", value=centers[np.argmax(hpix)])
+    params.add("ADU", value=5)
+    params.add("N", value=hpix.sum())
+    params.add("npoisson", value=npoisson, vary=False)
+    return lmfit.minimize(poisgaus.lmfitGausPoisson, params, args=(centers, hpix),
+                          Dfun=poisgaus.jacGausPoisson if jacobian else None)
+
+
+def main(npoisson=20, repeat=5):
+    par = [4.0, 0.3, 1000.0, 10.0, 4e6, npoisson]
+    centers, hpix = fakeHistogram(par)
+
+    # Accuracy of the model and the jacobian
+    diff = np.max(np.abs(poisgaus.fGausPoisson(centers, *par) - loopGausPoisson(centers, *par)))
+    print(f"Max difference from loop model:    {diff:.3g} (peak {hpix.max():.3g})")
+    grad = poisgaus.gradGausPoisson(centers, *par)
+    for i, name in enumerate(["sigma", "lamb", "offset", "ADU", "N"]):
+        step = 1e-6 * max(abs(par[i]), 1)
+        up, down = list(par), list(par)
+        up[i] += step
+        down[i] -= step
+        numeric = (poisgaus.fGausPoisson(centers, *up) - poisgaus.fGausPoisson(centers, *down)) / (2 * step)
+        error = np.max(np.abs(grad[name] - numeric)) / np.max(np.abs(numeric))
+        print(f"Relative jacobian error d/d{name:7s} {error:.3g}")
+
+    # Timing
+    nmodel = 1000
+    tloop = timeit.timeit(lambda: loopGausPoisson(centers, *par), number=nmodel) / nmodel
+    tvec = timeit.timeit(lambda: poisgaus.fGausPoisson(centers, *par), number=nmodel) / nmodel
+    print(f"Model evaluation, loop:            {tloop*1e6:.1f} us")
+    print(f"Model evaluation, vectorized:      {tvec*1e6:.1f} us")
+
+    for jacobian in (False, True):
+        result = fit(centers, hpix, npoisson, jacobian)
+        elapsed = timeit.timeit(lambda: fit(centers, hpix, npoisson, jacobian), number=repeat) / repeat
+        values = ", ".join(f"{name}={result.params[name].value:.4g}" for name in ("sigma", "lamb", "ADU"))
+        label = "analytic" if jacobian else "numeric"
+        print(f"Fit with {label:8s} jacobian:     {elapsed*1e3:.1f} ms, {result.nfev} evaluations, {values}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,119 @@
+import numpy as np
+from scipy import ndimage
+from astropy.io import fits
+
+# Columns of a cluster table and what they hold
+clusterColumns = [
+    ("hdu", "image HDU the cluster is in"),
+    ("x", "energy weighted mean column [pix]"),
+    ("y", "energy weighted mean row [pix]"),
+    ("npix", "number of pixels"),
+    ("energy", "sum of pixel values above the offset [ADU]"),
+    ("electrons", "energy divided by the ADU per electron [e-]"),
+    ("peak", "largest pixel value above the offset [ADU]"),
+    ("sigmaX", "energy weighted spread of the columns [pix]"),
+    ("sigmaY", "energy weighted spread of the rows [pix]"),
+    ("covXY", "energy weighted covariance of columns and rows [pix^2]"),
+]
+
+clusterDtype = np.dtype([(name, np.int32 if name in ("hdu", "npix") else np.float32) for name, _ in clusterColumns])
+
+
+def findClusters(image, sigma, offset, adu=1.0, nsigmaSeed=4.0, nsigmaAdd=2.0, connectivity=8):
+    """
+        Finds clusters of charge (tracks, hits) in an image in vectorized passes
+
+        Pixels more than nsigmaAdd noise sigmas above the offset are grouped into connected components, and components
+        containing at least one pixel more than nsigmaSeed sigmas above are kept as clusters
+
+        Inputs:
+            image - (nrows x ncolumns) ndarray of pixel values
+            sigma - double, noise of the image [ADU], e.g. from the Gauss-Poisson fit
+            offset - double, pixel value of zero charge [ADU]
+            adu - double, ADU per electron, to convert energies
+            nsigmaSeed - double, threshold for a pixel to start a cluster
+            nsigmaAdd - double, threshold for a pixel to join a cluster
+            connectivity - 4 or 8, whether diagonal neighbours are connected
+
+        Outputs:
+            clusters - (nclusters, ) structured numpy array with clusterDtype
+    """
+
+    sigma = abs(sigma)
+    image = np.asarray(image)
+    structure = np.ones((3, 3)) if connectivity == 8 else ndimage.generate_binary_structure(2, 1)
+    labels, nlabels = ndimage.label(image > offset + nsigmaAdd * sigma, structure=structure)
+    if nlabels == 0:
+        return np.zeros(0, dtype=clusterDtype)
+
+    # Per-cluster sums over the labeled pixels only, with one bincount each
+    index = np.flatnonzero(labels)
+    label = labels.ravel()[index]
+    y, x = np.divmod(index, image.shape[1])
+    charge = image.ravel()[index].astype(np.float64) - offset
+    sums = lambda weights: np.bincount(label, weights=weights, minlength=nlabels + 1)[1:]
+
+    npix = np.bincount(label, minlength=nlabels + 1)[1:]
+    energy = sums(charge)
+    peak = np.asarray(ndimage.maximum(image, labels, np.arange(1, nlabels + 1)), dtype=np.float64) - offset
+
+    meanX = sums(charge * x) / energy
+    meanY = sums(charge * y) / energy
+    varX = np.maximum(sums(charge * x * x) / energy - meanX ** 2, 0)
+    varY = np.maximum(sums(charge * y * y) / energy - meanY ** 2, 0)
+    covXY = sums(charge * x * y) / energy - meanX * meanY
+
+    keep = peak > nsigmaSeed * sigma
+    clusters = np.zeros(np.count_nonzero(keep), dtype=clusterDtype)
+    clusters["x"] = meanX[keep]
+    clusters["y"] = meanY[keep]
+    clusters["npix"] = npix[keep]
+    clusters["energy"] = energy[keep]
+    clusters["electrons"] = energy[keep] / adu
+    clusters["peak"] = peak[keep]
+    clusters["sigmaX"] = np.sqrt(varX[keep])
+    clusters["sigmaY"] = np.sqrt(varY[keep])
+    clusters["covXY"] = covXY[keep]
+
+    return clusters
+
+
+def summarizeClusters(clusters, highEnergy=1000.0):
+    """
+        Summary of a cluster table small enough to keep with the image's database entry
+
+        Inputs:
+            clusters - structured numpy array from findClusters
+            highEnergy - double, clusters with more electrons than this count as high energy
+
+        Outputs:
+            dict of the number of clusters, of high energy clusters, and the total and largest energy [e-]
+    """
+
+    electrons = clusters["electrons"]
+    return {
+        "count": int(clusters.size),
+        "highEnergy": int(np.count_nonzero(electrons > highEnergy)),
+        "highEnergyThreshold": float(highEnergy),
+        "totalElectrons": float(electrons.sum()),
+        "maxElectrons": float(electrons.max()) if clusters.size else 0.0,
+        "maxPixels": int(clusters["npix"].max()) if clusters.size else 0,
+    }
+
+
+def writeClusters(clusters, filename, header=None):
+    """
+        Saves a cluster table as a FITS binary table
+
+        Inputs:
+            clusters - structured numpy array from findClusters
+            filename - string, path of the file to write
+            header - dict of keywords to add, e.g. the thresholds used
+    """
+
+    table = fits.BinTableHDU(clusters, name="CLUSTERS")
+    for i, (name, description) in enumerate(clusterColumns):
+        table.header["TCOMM%d" % (i + 1)] = description
+    for key, value in (header or {}).items():
+        table.header[key] = value
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(filename, overwrite=True)
@@ -2,6 +2,56 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy.stats
 
+# Largest range of values (max - min) counted with bincount for integer images
+maxCountBins = 2 ** 24
+
+# Scale applied by scipy.stats.median_absolute_deviation to make the mad a gaussian sigma
+madScale = 1.4826
+
+
+def countValues(image, chunkSize=2 ** 20):
+    """
+	Counts how many pixels take each value of an integer image, a chunk of pixels at a time to bound the memory used
+	Inputs:
+		image - integer ndarray
+		chunkSize - number of pixels to count at once
+	Outputs:
+		counts - (max - min + 1, ) numpy array, counts[i] is the number of pixels equal to offset + i. None if the range
+		         of values is larger than maxCountBins
+		offset - int, the smallest value in the image
+	"""
+
+    flat = image.reshape(-1)
+    lo, hi = int(flat.min()), int(flat.max())
+    if hi - lo >= maxCountBins:
+        return None, lo
+
+    counts = np.zeros(hi - lo + 1, dtype=np.int64)
+    for start in range(0, flat.size, chunkSize):
+        chunk = flat[start:start + chunkSize].astype(np.int64)
+        chunk -= lo
+        counts += np.bincount(chunk, minlength=counts.size)
+
+    return counts, lo
+
+
+def countsMedian(values, counts):
+    """
+	Median of data given as sorted values and the number of times each occurs, matching np.median (the mean of the two
+	middle elements for an even number of elements)
+	Inputs:
+		values - (n, ) numpy array of values in increasing order
+		counts - (n, ) numpy array of the number of times each value occurs
+	Outputs:
+		median - double
+	"""
+
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    lower = values[np.searchsorted(cumulative, (total - 1) // 2, side="right")]
+    upper = values[np.searchsorted(cumulative, total // 2, side="right")]
+    return (lower + upper) / 2
+
 
 class Image(object):
     """
@@ -19,6 +69,17 @@ class Image(object):
         self.image = img
         self.filename = filename
 
+        # Number of pixels with each value, for integer images. See countValues
+        self.valueCounts = None
+        self.valueOffset = 0
+        if np.issubdtype(self.image.dtype, np.integer):
+            self.valueCounts, self.valueOffset = countValues(self.image)
+
+        # Results of fits to this image, see cachedFit
+        self.fitCache = {}
+        self.fitCacheHits = 0
+        self.fitCacheMisses = 0
+
         # Compute usefule statistics on the image
         self.estimateDistributionParameters()
         self.histogramImage(minRange=minRange)
@@ -34,16 +95,31 @@ class Image(object):
 	        mad - double of the median absolute deviation of the pixels excluding zeros
 	    """
 
-        if np.all(self.image <= 0):
+        if self.valueCounts is not None:
+            # Integer images: exact statistics from the counts of each value, without copying the pixels
+            values = np.arange(self.valueOffset, self.valueOffset + self.valueCounts.size)
+            positive = values > 0
+            values, counts = values[positive], self.valueCounts[positive]
+            if not np.any(counts):
+                self.med = 0
+                self.mad = 1
+            else:
+                self.med = countsMedian(values, counts)
+                # Deviations fold the values around the median; sort them to take their median the same way
+                deviation = np.abs(values - self.med)
+                order = np.argsort(deviation, kind="stable")
+                self.mad = np.max([madScale * countsMedian(deviation[order], counts[order]), 1])
+        elif np.all(self.image <= 0):
             # If all pixels are saturated, median = 0, mad = 1
             self.med = 0
             self.mad = 1
         else:
-            self.med = np.median(self.image[self.image > 0])
+            positive = self.image[self.image > 0]
+            self.med = np.median(positive)
             self.mad = np.max(
                 [
                     scipy.stats.median_absolute_deviation(
-                        self.image[self.image > 0], axis=None
+                        positive, axis=None
                     ),
                     1,
                 ]
@@ -74,13 +150,60 @@ class Image(object):
                 np.ceil(self.med + nsigma * self.mad),
             )
 
-        hpix, edges = np.histogram(self.image, bins=bins)
+        if self.valueCounts is not None:
+            hpix, edges = self.histogramCounts(bins)
+        else:
+            hpix, edges = np.histogram(self.image, bins=bins)
         centers = edges[:-1] + np.diff(edges)[0] / 2
 
         self.hpix, self.centers, self.edges = hpix, centers, edges
+        # fits of the previous histogram no longer apply
+        self.fitCache = {}
 
         return hpix, centers, edges
 
+    def histogramCounts(self, bins):
+        """
+		Same result as np.histogram(self.image, bins=bins) for integer spaced bins with integer edges, taken from
+		valueCounts instead of another pass over the image
+		Inputs:
+			bins - (nbins+1, ) numpy array of integer bin edges, spaced by 1
+		Outputs:
+			hpix - (nbins, ) numpy array of the histogram weights
+			edges - (nbins+1, ) numpy array of the bin edges
+		"""
+
+        # valueCounts padded with zeros to cover every edge
+        index = bins.astype(np.int64) - self.valueOffset
+        inRange = (index >= 0) & (index < self.valueCounts.size)
+        counts = np.zeros(bins.size, dtype=np.int64)
+        counts[inRange] = self.valueCounts[index[inRange]]
+
+        # np.histogram includes the right edge in the last bin
+        hpix = counts[:-1].copy()
+        if hpix.size:
+            hpix[-1] += counts[-1]
+        return hpix, bins
+
+    def cachedFit(self, key, fit):
+        """
+		Memoizes fits to this image so each distinct fit only runs once, however many metrics use it. The cache is
+		cleared whenever the histogram changes, see histogramImage
+		Inputs:
+			key - hashable description of the fit, including every setting that changes its result
+			fit - function with no arguments that performs the fit if it is not cached
+		Outputs:
+			result of fit(), shared between all callers so it should not be modified
+		"""
+
+        if key in self.fitCache:
+            self.fitCacheHits += 1
+        else:
+            self.fitCacheMisses += 1
+            self.fitCache[key] = fit()
+
+        return self.fitCache[key]
+
     def plotSpectrum(self, bins=None):
         """
             Plots the histgram of the image
@@ -129,6 +252,7 @@ class DamicImage(Image):
 
         # Shifts the histogram axis (centers and edges) to be centered around zero and flips the values
         self.hpix = np.flip(self.hpix)
+        self.fitCache = {}
         # self.centers = (self.centers - self.med)
         # self.edges = (self.edges - self.med)
 
@@ -1,10 +1,12 @@
 import numpy as np
 import scipy.stats
+import scipy.special
 import scipy.optimize as optimize
 import matplotlib.pyplot as plt
 from scipy.special import factorial
 import DamicImage
-from PoissonGausFit import computeGausPoissDist, paramsToList, fGausPoisson
+import SkipperStatistics
+from PoissonGausFit import computeGausPoissDist, paramsToList, fGausPoisson, fCDFGausPoisson
 
 
 def imageEntropy(image):
@@ -22,7 +24,7 @@ def imageEntropy(image):
 
     # Compute the entropy
     pixelProbabilityDistribution = pixelVals / np.sum(pixelVals)
-    entropy = np.sum([-p * np.log(p) for p in pixelProbabilityDistribution if p > 0])
+    entropy = -np.sum(scipy.special.xlogy(pixelProbabilityDistribution, pixelProbabilityDistribution))
 
     return entropy
 
@@ -39,12 +41,9 @@ def imageEntropySlope(skImage, maxNskips=30):
     if len(skImage.shape) < 3 or skImage.shape[-1] == 1:
         return (-1, -1, -1)
 
-    nskips = skImage.shape[2]
-    nskips = np.min([nskips, maxNskips])
-    singleImageEntropy = np.zeros(nskips)
-
-    for i in range(nskips):
-        singleImageEntropy[i] = imageEntropy(skImage[:, :, i])
+    # Entropy of every skip from one pass over the cube
+    singleImageEntropy = SkipperStatistics.SkipperCube(skImage, maxNskips=maxNskips).entropy()
+    nskips = singleImageEntropy.size
 
     # Fit with linear regression
     linfunc = lambda x, *p: p[0] + p[1] * x
@@ -58,41 +57,21 @@ def imageEntropySlope(skImage, maxNskips=30):
     return paramFit[1] * 1e3, np.sqrt(np.diag(paramCov))[1] * 1e3, singleImageEntropy
 
 
-def computeImageNoise(skImage, maxNskips=50):
+def computeImageNoise(skImage, maxNskips=50, workers=None):
     """
-	Computes the noise of the image by fitting the zero electron peak to a gaussian
+	Computes the noise of the image by fitting the zero electron peak of each skip to a gaussian
+	Inputs:
+		skImage - (nrows x ncolumns [x nskips]) numpy array
+		maxNskips - int, only fit the first maxNskips skips
+		workers - int, number of processes to run the fits in. None uses every cpu, 1 fits in this process
+	Outputs:
+		noise - double, mean of the fitted sigmas, ignoring skips where the fit failed
 	"""
 
-    # Figure out how many skips in the image
-    if len(skImage.shape) == 2:
-        nskips = 1
-        skImage = np.expand_dims(skImage, 2)
-    else:
-        nskips = skImage.shape[-1]
-
-    nskips = np.min([nskips, maxNskips])
-
-    # Define gaussian fit
-    gausfunc = lambda x, *p: p[0] * np.exp(-(x - p[1]) ** 2 / (2 * p[2] ** 2))
+    # Histograms of every skip from one pass over the cube, fitted independently
+    imageNoiseVec = SkipperStatistics.SkipperCube(skImage, maxNskips=maxNskips).noise(workers=workers)
 
-    # Iterate over each image in the skipped image, fit Guassian to the noise
-    imageNoiseVec = []
-    for i in range(nskips):
-
-        # Create histogram of pixels
-        med, mad = estimateDistributionParameters(skImage[:, :, i])
-        bins = np.arange(med - 3 * mad, med + 3 * mad)
-        y, xedges = np.histogram(skImage[:, :, i], bins=bins)
-        xcenter = xedges[:-1] + np.diff(xedges)[0]
-
-        # Perform fit
-        paramGuess = [np.sum(y) / np.sqrt(2 * np.pi * mad ** 2), med, mad]
-        paramOpt, _ = optimize.curve_fit(gausfunc, xcenter, y, p0=paramGuess)
-
-        # Append to vector
-        imageNoiseVec.append(paramOpt[2])
-
-    return np.mean(imageNoiseVec)
+    return np.nanmean(imageNoiseVec)
 
 
 def computeSkImageNoise(damicImage, nMovingAverage=10):
@@ -279,13 +258,14 @@ def findPeakPosition(histogram, bins, nMovingAverage=10, dthresh=2):
     return maximaLoc, minimaLoc
 
 
-def computeImageTailRatio(damicimage, nsigma=4.0):
+def computeImageTailRatio(damicimage, nsigma=4.0, npoisson=10):
     """
 	Calculates the ratio of the number of pixels in the left tail of the distribution to the number expected if it was
 	just gaussian noise
 	Inputs:
 		image - (nrows, ncols, [nskips]) numpy array. Should be raw images and not the combined image
 		nsigma - double, threshold definition of the tail
+		npoisson - int, number of poisson terms in the fit. Use the same value as other metrics to share their fit
 	Outputs:
 		tailRatio - double, ratio of actual to expected number of points in the tail of the variance distribution. >> 1 is a proxy for tracks
 
@@ -297,19 +277,24 @@ def computeImageTailRatio(damicimage, nsigma=4.0):
     binedges = damicimage.edges
 
     # Peform fit of Poisson + Gaus
-    minpar = computeGausPoissDist(damicimage)
+    minpar = computeGausPoissDist(damicimage, npoisson=npoisson)
     par = paramsToList(minpar.params)
 
     # Expected n*sigma number of events in dist
     nGreaterThanNSigma = scipy.stats.norm.sf(nsigma) * par[4]
 
-    # Find the x location that gives us our n sigma threshold
-    gausPoisInt = lambda x: scipy.integrate.quad(fGausPoisson, x, binedges[-1], args=tuple(par))[0] - nGreaterThanNSigma
-    tailLocation = scipy.optimize.fsolve(gausPoisInt, binedges[binedges.size//2])
+    # Find the x location that gives us our n sigma threshold. The integral of the fit above x is given by its CDF,
+    # and falls monotonically with x, so the root is bracketed by the histogram range
+    cdfEnd = fCDFGausPoisson(binedges[-1], *par)
+    gausPoisInt = lambda x: par[4] * (cdfEnd - fCDFGausPoisson(x, *par)) - nGreaterThanNSigma
+    if gausPoisInt(binedges[0]) <= 0:
+        tailLocation = binedges[0]
+    else:
+        tailLocation = scipy.optimize.brentq(gausPoisInt, binedges[0], binedges[-1])
 
 
     # Compute the ratio between the tails of the data to the fit
-    tailRatio = np.sum(damicimage.image > tailLocation) / nGreaterThanNSigma
+    tailRatio = np.count_nonzero(damicimage.image > tailLocation) / nGreaterThanNSigma
 
     return tailRatio
 
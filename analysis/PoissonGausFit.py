@@ -2,14 +2,25 @@ import numpy as np
 import scipy.stats
 import scipy.optimize as optimize
 import matplotlib.pyplot as plt
-from scipy.special import factorial, erf
+from scipy.special import erf, gammaln, xlogy
 import lmfit
 import DamicImage
 
 
 def computeGausPoissDist(damicImage, aduConversion=-1, npoisson=10):
     """
-        Computes pixel distribution as a convolution of gaussian with poisson
+        Computes pixel distribution as a convolution of gaussian with poisson. The result is cached on damicImage, so
+        repeated calls with the same settings return the same lmfit result without refitting
+    """
+
+    key = ("GausPoisson", aduConversion, int(npoisson))
+    return damicImage.cachedFit(key, lambda: fitGausPoissDist(damicImage, aduConversion, npoisson))
+
+
+def fitGausPoissDist(damicImage, aduConversion=-1, npoisson=10):
+    """
+        Fits the pixel distribution with a convolution of gaussian with poisson. Use computeGausPoissDist instead to
+        reuse earlier fits of the same image
     """
 
 
@@ -24,17 +35,36 @@ def computeGausPoissDist(damicImage, aduConversion=-1, npoisson=10):
         params.add("ADU", value=5)
     params.add("N", value=damicImage.image.size)
     params.add("npoisson", value=npoisson, vary=False)
-    minimized = lmfit.minimize(lmfitGausPoisson, params, args=(damicImage.centers, damicImage.hpix))
+    minimized = lmfit.minimize(lmfitGausPoisson, params, args=(damicImage.centers, damicImage.hpix), Dfun=jacGausPoisson)
 
     # Operations on the returned values to parse into a useful format
     return minimized
 
+def poissonWeights(lamb, npoiss):
+    """
+        Poisson probabilities of k = 0 ... npoiss-1 electrons, computed in log space so large k neither overflows
+        lamb**k and k! nor loses precision
+
+        Inputs:
+            lamb - double, mean of the poisson process
+            npoiss - int, number of terms
+
+        Outputs:
+            k - (npoiss, ) numpy array of the number of electrons
+            weights - (npoiss, ) numpy array of the probability of each k
+    """
+    k = np.arange(int(npoiss))
+    # xlogy gives 0 * log(0) = 0, so lamb = 0 is allowed
+    weights = np.exp(xlogy(k, lamb) - lamb - gammaln(k + 1))
+    return k, weights
+
+
 def fGausPoisson(x, *par):
     """
         Convolution of a gaussian and poisson.
 
         Inputs:
-            x - double, value of function to be evaluated
+            x - double or ndarray, value of function to be evaluated
             par - list of parameters
                 par[0] - sigma, width of gaussians
                 par[1] - lamb, mean of poisson process (lambda is python reserved keyword)
@@ -44,18 +74,14 @@ def fGausPoisson(x, *par):
                 par[5] - npoiss, number of terms in the poisson process. This should be fixed
 
         Outputs:
-            double, value of the function
+            double or ndarray, value of the function
     """
-    sigma = par[0]
-    lamb = par[1]
-    offset = par[2]
-    a = par[3]
-    N = par[4]
-    npoiss = par[5]
+    sigma, lamb, offset, a, N, npoiss = par[:6]
+    k, weights = poissonWeights(lamb, npoiss)
 
-    y = 0
-    for k in range(npoiss):
-        y += ( lamb**k * np.exp(-lamb) / factorial(k) * np.exp( - (a*k - (x - offset))**2 / (2 * sigma**2)) ) 
+    # broadcast over k along a new last axis, then sum it out
+    u = np.expand_dims(x, -1) - offset - a * k
+    y = np.exp(-u**2 / (2 * sigma**2)) @ weights
 
     return y * N / np.sqrt(2 * np.pi * sigma**2)
 
@@ -65,47 +91,80 @@ def fCDFGausPoisson(x, *par):
         Cumulative distribution function of a gaussian convolved with a poisson
 
         Inputs:
-            x - double, value of function to be evaluated
+            x - double or ndarray, value of function to be evaluated
             par - list of parameters
                 par[0] - sigma, width of gaussians
                 par[1] - lamb, mean of poisson process (lambda is python reserved keyword)
                 par[2] - offset, shift of distribution relative to zero
-                par[0] - a, electron to ADU conversion
-                par[0] - N, amplitude of distribution (npixels)
-                par[0] - npoiss, number of terms in the poisson process. This should be fixed
+                par[3] - a, electron to ADU conversion
+                par[4] - N, amplitude of distribution (npixels)
+                par[5] - npoiss, number of terms in the poisson process. This should be fixed
 
         Outputs:
-            double, value of the cumulative distribution function
+            double or ndarray, value of the cumulative distribution function
     """
-    sigma = par[0]
-    lamb = par[1]
-    offset = par[2]
-    a = par[3]
-    N = par[4]
-    npoiss = par[5]
+    sigma, lamb, offset, a, N, npoiss = par[:6]
+    k, weights = poissonWeights(lamb, npoiss)
 
-    y = 0
-    for k in range(npoiss):
-        y += ( lamb**k * np.exp(-lamb) / factorial(k) * 0.5 * (1 + erf((x - offset - a*k) / (sigma * np.sqrt(2)))) )  
+    u = np.expand_dims(x, -1) - offset - a * k
+    y = 0.5 * (1 + erf(u / (sigma * np.sqrt(2)))) @ weights
 
     return y 
 
+
+def gradGausPoisson(x, *par):
+    """
+        Partial derivatives of fGausPoisson with respect to each of its parameters
+
+        Inputs:
+            x - ndarray, values the function is evaluated at
+            par - list of parameters, as fGausPoisson
+
+        Outputs:
+            dict of parameter name (as in computeGausPoissDist) -> ndarray of the derivative at each x
+    """
+    sigma, lamb, offset, a, N, npoiss = par[:6]
+    k, weights = poissonWeights(lamb, npoiss)
+
+    u = np.expand_dims(np.asarray(x, dtype=float), -1) - offset - a * k
+    gaus = np.exp(-u**2 / (2 * sigma**2))
+    norm = 1 / np.sqrt(2 * np.pi * sigma**2)
+
+    # d/dlamb of a poisson weight is w[k-1] - w[k], which avoids dividing by lamb
+    dweights = -weights
+    dweights[1:] += weights[:-1]
+
+    wgaus = gaus * weights
+    wgausu = wgaus * u
+    model = N * norm * wgaus.sum(axis=-1)
+    return {
+        "sigma": N * norm * (wgausu * u).sum(axis=-1) / sigma**3 - model / sigma,
+        "lamb": N * norm * (gaus @ dweights),
+        "offset": N * norm * wgausu.sum(axis=-1) / sigma**2,
+        "ADU": N * norm * (wgausu @ k) / sigma**2,
+        "N": norm * wgaus.sum(axis=-1),
+    }
+
+
 def lmfitGausPoisson(param, x, data):
     """
     LMFIT function for a gaussian convolved with a poisson distribution
     """
 
-    sigma = param["sigma"]
-    lamb = param["lamb"]
-    offset = param["offset"]
-    a = param["ADU"]
-    N = param["N"]
-    npoiss = param["npoisson"]
-    par = [sigma, lamb, offset, a, N, npoiss.value]
-
-    model = fGausPoisson(x, *par)
+    model = fGausPoisson(x, *paramsToList(param))
     return (data-model)
 
+
+def jacGausPoisson(param, x, data):
+    """
+    Analytic jacobian of lmfitGausPoisson for lmfit.minimize(..., Dfun=jacGausPoisson). Has one column for each
+    varying parameter, in the order they were added
+    """
+
+    grad = gradGausPoisson(x, *paramsToList(param))
+    varying = [name for name, p in param.items() if p.vary and not p.expr]
+    return -np.stack([grad[name] for name in varying], axis=-1)
+
 def parseFitMinimum(fitmin):
     """
         Takes to fit minimum and parses it into a dictionary of useful parameters
@@ -0,0 +1,270 @@
+import os
+import multiprocessing
+import numpy as np
+import scipy.optimize as optimize
+from scipy.special import xlogy
+from concurrent.futures import ProcessPoolExecutor
+
+# Scale applied by scipy.stats.median_absolute_deviation to make the mad a gaussian sigma
+madScale = 1.4826
+
+# Largest (nskips x value range) table of counts before falling back to per-skip passes
+maxCountBins = 2 ** 26
+
+# Fewer fits than this run in this process, since starting a pool costs more than it saves
+minPoolFits = 32
+
+
+def gausfunc(x, *p):
+    """
+        Gaussian used for the noise fits, p = [amplitude, mean, sigma]
+    """
+    return p[0] * np.exp(-(x - p[1]) ** 2 / (2 * p[2] ** 2))
+
+
+def fitGaussian(problem):
+    """
+        Fits gausfunc to one histogram. Top level so it can run in a worker process
+        Inputs:
+            problem - (xcenter, y, paramGuess) tuple
+        Outputs:
+            paramOpt - numpy array of the fitted [amplitude, mean, sigma], all nan if the fit fails
+    """
+    xcenter, y, paramGuess = problem
+    try:
+        paramOpt, _ = optimize.curve_fit(gausfunc, xcenter, y, p0=paramGuess)
+    except (RuntimeError, ValueError):
+        paramOpt = np.full(3, np.nan)
+    return paramOpt
+
+
+def fitGaussians(problems, workers=None):
+    """
+        Runs fitGaussian on every problem, in a process pool when there are enough of them
+        Inputs:
+            problems - list of (xcenter, y, paramGuess) tuples
+            workers - int, number of worker processes. None uses every cpu, 1 fits in this process
+        Outputs:
+            list of fitted parameters in the same order as problems
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(problems) < minPoolFits:
+        return [fitGaussian(problem) for problem in problems]
+    # a fork of a threaded process, like the GUI, can inherit locks held by its other threads
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        return list(pool.map(fitGaussian, problems, chunksize=max(1, len(problems) // (4 * workers))))
+
+
+def rowMedians(values, counts):
+    """
+        Median of each row of data given as values and the number of times each occurs, matching np.median
+        Inputs:
+            values - (nrows, nvalues) numpy array, increasing along each row
+            counts - (nrows, nvalues) numpy array of the number of times each value occurs
+        Outputs:
+            medians - (nrows, ) numpy array, nan for rows without any counts
+    """
+    cumulative = np.cumsum(counts, axis=1)
+    total = cumulative[:, -1:]
+    lower = np.argmax(cumulative > (total - 1) // 2, axis=1)
+    upper = np.argmax(cumulative > total // 2, axis=1)
+    rows = np.arange(values.shape[0])
+    medians = (values[rows, lower] + values[rows, upper]) / 2
+    medians[total[:, 0] == 0] = np.nan
+    return medians
+
+
+class SkipperCube(object):
+    """
+        Per-skip statistics of a skipper image
+
+        Pixel values of every skip are counted in one chunked pass over the (nrows x ncolumns x nskips) cube with a
+        single bincount, and entropies, medians, mads and noise histograms of all skips are computed from those counts
+        together. Cubes of float values or with too wide a range of values to count are instead read one skip and
+        one block of rows at a time, so memory maps of large cubes are never copied whole.
+
+        Use:
+            cube = SkipperCube(skImage, maxNskips=<int>)
+            cube.entropy(), cube.noise()
+    """
+
+    def __init__(self, skImage, maxNskips=None, chunkPixels=2 ** 22):
+        """
+            Inputs:
+                skImage - (nrows x ncolumns [x nskips]) ndarray, may be a memory map
+                maxNskips - int, only use the first maxNskips skips
+                chunkPixels - number of values to convert at once while counting
+        """
+        if skImage.ndim == 2:
+            skImage = np.expand_dims(skImage, 2)
+        if maxNskips:
+            skImage = skImage[:, :, :maxNskips]
+        self.cube = skImage
+        self.nskips = skImage.shape[2]
+        self.chunkPixels = chunkPixels
+
+        self.skipMin = self.cube.min(axis=(0, 1))
+        self.skipMax = self.cube.max(axis=(0, 1))
+        self.counts = self.countValues()
+
+    def countValues(self):
+        """
+            Counts the pixels in each unit wide bin above the minimum of each skip
+            Outputs:
+                counts - (nskips, nbins) numpy array, counts[s, i] is the number of pixels of skip s with
+                         floor(value - skipMin[s]) == i. None if the table would be larger than maxCountBins
+        """
+        nbins = int(np.floor(np.max(self.skipMax - self.skipMin))) + 1
+        if nbins * self.nskips > maxCountBins:
+            return None
+
+        # offset each skip into its own block of bins so one bincount fills the whole table
+        skipOffset = np.arange(self.nskips) * nbins
+        counts = np.zeros(self.nskips * nbins, dtype=np.int64)
+        integer = np.issubdtype(self.cube.dtype, np.integer)
+        for rows in self.rowChunks():
+            chunk = self.cube[rows]
+            if integer:
+                index = chunk.astype(np.int64) - self.skipMin.astype(np.int64)
+            else:
+                index = np.floor(chunk - self.skipMin).astype(np.int64)
+            index += skipOffset
+            counts += np.bincount(index.ravel(), minlength=counts.size)
+
+        return counts.reshape(self.nskips, nbins)
+
+    def rowChunks(self):
+        """
+            Slices of rows to read the cube in, chunkPixels values at a time
+        """
+        rowsPerChunk = max(1, self.chunkPixels // (self.cube.shape[1] * self.nskips))
+        for start in range(0, self.cube.shape[0], rowsPerChunk):
+            yield slice(start, start + rowsPerChunk)
+
+    def countSkip(self, s):
+        """
+            Counts of one skip in unit wide bins above its minimum, for cubes whose table of counts of every skip
+            would be too large. Only one block of rows and one skip's counts are in memory at a time
+            Outputs:
+                counts - numpy array, counts[i] is the number of pixels with floor(value - skipMin[s]) == i
+        """
+        counts = np.zeros(int(np.floor(self.skipMax[s] - self.skipMin[s])) + 1, dtype=np.int64)
+        for rows in self.rowChunks():
+            # imageEntropy's bins start at the minimum of each skip, so only floor(value - min) is needed
+            index = np.floor(self.cube[rows, :, s] - self.skipMin[s]).astype(np.int64)
+            counts += np.bincount(index.ravel(), minlength=counts.size)
+        return counts
+
+    def positiveValues(self, s):
+        """
+            The positive pixel values of one skip, gathered a block of rows at a time
+        """
+        values = [chunk[chunk > 0] for chunk in (self.cube[rows, :, s] for rows in self.rowChunks())]
+        return np.concatenate(values).astype(float)
+
+    def binValues(self):
+        """
+            Lower edge of each bin of counts, (nskips, nbins) numpy array
+        """
+        return self.skipMin[:, None] + np.arange(self.counts.shape[1])
+
+    def entropy(self):
+        """
+            Shannon entropy (-sum p log p) of the pixel distribution of every skip, binned as imageEntropy does
+            Outputs:
+                entropy - (nskips, ) numpy array
+        """
+        if self.counts is None:
+            return np.array([imageEntropyFromCounts(self.countSkip(s), self.skipMax[s] - self.skipMin[s])
+                             for s in range(self.nskips)])
+        return np.array([imageEntropyFromCounts(self.counts[s], self.skipMax[s] - self.skipMin[s])
+                         for s in range(self.nskips)])
+
+    def medianMad(self):
+        """
+            Median and mad of the positive pixels of every skip, as estimateDistributionParameters
+            Outputs:
+                med - (nskips, ) numpy array
+                mad - (nskips, ) numpy array, at least 1
+        """
+        if self.counts is not None and np.issubdtype(self.cube.dtype, np.integer):
+            values = self.binValues()
+            counts = np.where(values > 0, self.counts, 0)
+            med = rowMedians(values, counts)
+            # deviations fold the values around the median; sort them to take their median the same way
+            deviation = np.abs(values - med[:, None])
+            order = np.argsort(deviation, axis=1, kind="stable")
+            mad = madScale * rowMedians(np.take_along_axis(deviation, order, axis=1),
+                                        np.take_along_axis(counts, order, axis=1))
+        else:
+            # the median needs every value of a skip, but only of one skip at a time
+            med = np.full(self.nskips, np.nan)
+            mad = np.full(self.nskips, np.nan)
+            for s in range(self.nskips):
+                pixels = self.positiveValues(s)
+                if pixels.size:
+                    med[s] = np.median(pixels)
+                    mad[s] = madScale * np.median(np.abs(pixels - med[s]))
+
+        # If all pixels are saturated, median = 0, mad = 1
+        saturated = np.isnan(med)
+        med[saturated] = 0
+        mad[saturated | np.isnan(mad)] = 1
+        return med, np.maximum(mad, 1)
+
+    def histograms(self, nsigma=3):
+        """
+            Histograms of every skip over median +/- nsigma * mad, with the bins computeImageNoise uses
+            Outputs:
+                list of (y, edges) per skip, as np.histogram returns
+        """
+        med, mad = self.medianMad()
+        result = []
+        for s in range(self.nskips):
+            edges = np.arange(med[s] - nsigma * mad[s], med[s] + nsigma * mad[s])
+            if self.counts is None or edges.size < 2 or not np.issubdtype(self.cube.dtype, np.integer):
+                y, edges = np.histogram(self.cube[:, :, s], bins=edges)
+            else:
+                # Every integer value falls in one bin, and the last bin includes its right edge
+                values = self.skipMin[s] + np.arange(self.counts.shape[1])
+                inRange = (values >= edges[0]) & (values <= edges[-1])
+                index = np.minimum(np.floor(values[inRange] - edges[0]).astype(np.int64), edges.size - 2)
+                y = np.bincount(index, weights=self.counts[s, inRange], minlength=edges.size - 1).astype(np.int64)
+            result.append((y, edges))
+        return result
+
+    def noise(self, nsigma=3, workers=None):
+        """
+            Noise of every skip from a gaussian fit to its zero electron peak, as computeImageNoise
+            Inputs:
+                nsigma - number of mads around the median to fit
+                workers - int, number of processes to fit in, see fitGaussians
+            Outputs:
+                sigma - (nskips, ) numpy array, nan where the fit failed
+        """
+        med, mad = self.medianMad()
+        problems = []
+        for s, (y, edges) in enumerate(self.histograms(nsigma)):
+            xcenter = edges[:-1] + np.diff(edges)[0]
+            paramGuess = [np.sum(y) / np.sqrt(2 * np.pi * mad[s] ** 2), med[s], mad[s]]
+            problems.append((xcenter, y, paramGuess))
+        return np.array([param[2] for param in fitGaussians(problems, workers)])
+
+
+def imageEntropyFromCounts(counts, valueRange):
+    """
+        Entropy of a distribution given as counts in unit bins from its minimum. The last bin of imageEntropy's
+        histogram also holds the values on its right edge, so counts past it are added to it
+        Inputs:
+            counts - numpy array of counts in unit bins from the minimum value
+            valueRange - double, maximum - minimum value
+        Outputs:
+            entropy - double
+    """
+    nbins = max(int(np.ceil(valueRange + 1)) - 1, 1)
+    counts = counts[:nbins + 1].astype(float)
+    if counts.size > nbins:
+        counts[nbins - 1] += counts[nbins:].sum()
+        counts = counts[:nbins]
+    p = counts / np.sum(counts)
+    return -np.sum(xlogy(p, p))
@@ -2,8 +2,19 @@
 ## Web app logs
 LOGFILE = 'logs/CCDDroneGUI.log'
 LOGLEVEL = 'WARNING'
-## Logs for CCDDrone executables
+## Logs for CCDDrone executables. Set to None to only keep the last
+## EXECUTOR_OUTPUTLINES lines in memory
 EXECUTOR_LOGFILE = 'logs/Executor.log'
+#EXECUTOR_OUTPUTLINES = 1000
+## Where the queue of pending CCDDrone jobs is saved across restarts
+EXECUTOR_QUEUEFILE = 'logs/ExecutorQueue.json'
+## Status stream: seconds between keep-alives, and before clients reconnect
+#STATUSSTREAM_KEEPALIVE = 15
+#STATUSSTREAM_LIFETIME = 600
+## Status streams open at once; each holds a server thread (see start.sh)
+#STATUSSTREAM_MAXCLIENTS = 8
+## While a process runs, refresh the cached status at least this often (s)
+#STATUS_MAXAGE = 1
 
 ## Put application in DEBUG mode? Not quite sure what the differences are
 DEBUG = False
@@ -21,6 +32,14 @@ IMAGEDB_COLLECTION = "ccdimages"
 ## External links section of navbar. List of (url, label) pairs
 #SITE_EXTERNAL_LINKS = []
 
+## Memory (MB) for images rendered by the database browser
+#IMAGECACHE_MB = 256
+## Where zoomable image tiles are kept, and their size in pixels
+#TILECACHE_PATH = 'data/.tiles'
+#TILE_SIZE = 256
+## Largest box /api/roi and median profiles will read, in pixels
+#ROI_MAXPIXELS = 4*1024*1024
+
 ####### CCDDrone configuration #############
 ## where are output .fits files stored?
 DATAPATH = 'data'
@@ -30,5 +49,43 @@ CCDDRONEPATH = 'DummyDrone'
 CCDDCONFIGFILE = 'config/Config_GUI.ini'
 ## Name for metadata file generated by GUI (relative to CCDDRONEPATH)
 CCDDMETADATAFILE = 'config/Metadata_GUI.json'
+## To run several CCDs from one server, name each device and give the keys
+## that differ from the settings above. Log, queue, config, metadata and
+## preview files get the device name appended, and images go to
+## DATAPATH/<device>. Pages select a device with ?device=<name>
+#DEVICES = {
+#    'ccd1': {'CCDDRONEPATH': '/opt/CCDDrone1'},
+#    'ccd2': {'CCDDRONEPATH': '/opt/CCDDrone2'},
+#}
+## Start the next exposure as soon as the fits file is written, and do the
+## database entry, thumbnail and analysis in the background?
+#EXPOSE_PIPELINED = True
+## Exposures waiting for post-processing before the exposure loop pauses
+#PIPELINE_MAXPENDING = 4
+## Preview of the last image: downsampling factor, percent of pixels inside
+## the display range, and stretch (linear, sqrt, log or asinh)
+#THUMBNAIL_REDUCE = 2
+#THUMBNAIL_PERCENT = 98
+#THUMBNAIL_STRETCH = 'linear'
+## Skipper images (type = SK) are combined to one value per pixel before the
+## preview and analysis: mean or median of the NDCM samples, and how many MB
+## of raw samples to process at once
+#SKIPPER_COMBINE = 'mean'
+#SKIPPER_CHUNK_MB = 64
+## Processes fitting each amplifier and HDU of an image on its own (default
+## one per cpu, 1 to fit them in the web server process)
+#ANALYSIS_WORKERS = None
+## Overscan columns (of each amplifier) and rows whose median bias is
+## subtracted from each row and column before the preview and analysis, unless
+## the image header (OVRSCANX, OVRSCANY) or the CCDDrone config [ccd]
+## (overscan_columns, overscan_rows) say otherwise
+#OVERSCAN_COLUMNS = 0
+#OVERSCAN_ROWS = 0
+## Clusters with more electrons than this count as high energy tracks
+#CLUSTER_HIGHENERGY = 1000
+
+## Seconds per command (and per image 'readout') used to estimate how long
+## a sequence plan takes
+#SEQUENCE_DURATIONS = {'StartupAndErase': 30, 'readout': 100}
 
 
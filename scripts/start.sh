@@ -10,8 +10,10 @@ CFGFILE="$1"
 [ -z "$PORT" ] && PORT=5001
 
 
+# each open status stream (one per browser tab) holds a thread; at most
+# STATUSSTREAM_MAXCLIENTS of them, which leaves the rest for other requests
 export GUNICORN_CMD_ARGS="--capture-output --log-file=logs/gunicorn.error \
-  --reload -b 0.0.0.0:$PORT -w 1 -D --pid logs/gunicorn.pid --threads 4"
+  --reload -b 0.0.0.0:$PORT -w 1 -D --pid logs/gunicorn.pid --threads 16"
 
 ./venv/bin/gunicorn "CCDDroneGUI:create_app($CFGFILE)"
 
@@ -0,0 +1,121 @@
+/* Pan and zoom over a tile pyramid served by /api/tiles.
+ *
+ * new TileViewer(container, baseurl) fills `container` (a sized div) with
+ * the tiles needed for the current view, choosing the pyramid level that
+ * matches the zoom. Drag to pan, scroll to zoom, double click to reset.
+ */
+function TileViewer(container, baseurl){
+  var self = this;
+  self.container = $(container).css({position: 'relative', overflow: 'hidden',
+                                      cursor: 'move', background: 'black'});
+  self.baseurl = baseurl;
+  self.tiles = {};
+  self.onmove = null;
+  $.getJSON(baseurl+'/info', function(info){
+    self.info = info;
+    self.reset();
+  }).fail(function(xhr){
+    self.container.text("Unable to load image: "+xhr.statusText);
+  });
+
+  var drag = null;
+  self.container.on('mousedown', function(e){
+    drag = {x: e.pageX, y: e.pageY};
+    e.preventDefault();
+  });
+  $(document).on('mouseup', function(){ drag = null; });
+  $(document).on('mousemove', function(e){
+    if(drag && self.info){
+      self.x -= (e.pageX - drag.x) / self.scale;
+      self.y -= (e.pageY - drag.y) / self.scale;
+      drag = {x: e.pageX, y: e.pageY};
+      self.draw();
+    }
+  });
+  self.container.on('mousemove', function(e){
+    if(self.info && self.onmove){
+      var pos = self.topixel(e);
+      self.onmove(pos.x, pos.y);
+    }
+  });
+  self.container.on('wheel', function(e){
+    e.preventDefault();
+    var delta = e.originalEvent.deltaY;
+    self.zoomat(delta < 0 ? 1.25 : 0.8, e);
+  });
+  self.container.on('dblclick', function(){ self.reset(); });
+  $(window).on('resize', function(){ self.draw(); });
+}
+
+/* data pixel under the mouse; the first data row is at the bottom */
+TileViewer.prototype.topixel = function(e){
+  var offset = this.container.offset();
+  var x = this.x + (e.pageX - offset.left) / this.scale;
+  var y = this.y + (e.pageY - offset.top) / this.scale;
+  return {x: Math.floor(x), y: this.info.height - 1 - Math.floor(y)};
+};
+
+TileViewer.prototype.reset = function(){
+  var info = this.info;
+  this.minscale = Math.min(this.container.width() / info.width,
+                           this.container.height() / info.height);
+  this.scale = this.minscale;
+  this.x = 0;
+  this.y = 0;
+  this.draw();
+};
+
+TileViewer.prototype.zoomat = function(factor, e){
+  if(!this.info) return;
+  var offset = this.container.offset();
+  var cx = e ? e.pageX - offset.left : this.container.width() / 2;
+  var cy = e ? e.pageY - offset.top : this.container.height() / 2;
+  var newscale = Math.max(this.minscale / 2, Math.min(16, this.scale*factor));
+  // keep the point under the cursor fixed
+  this.x += cx / this.scale - cx / newscale;
+  this.y += cy / this.scale - cy / newscale;
+  this.scale = newscale;
+  this.draw();
+};
+
+TileViewer.prototype.draw = function(){
+  var info = this.info;
+  if(!info) return;
+  var width = this.container.width(), height = this.container.height();
+  // the smallest level with at least one tile pixel per screen pixel
+  var level = info.maxlevel + Math.ceil(Math.log2(this.scale) - 1e-9);
+  level = Math.max(0, Math.min(info.maxlevel, level));
+  var span = info.tilesize * Math.pow(2, info.maxlevel - level);
+  var col0 = Math.max(0, Math.floor(this.x / span));
+  var row0 = Math.max(0, Math.floor(this.y / span));
+  var col1 = Math.min(Math.ceil(info.width / span),
+                      Math.ceil((this.x + width / this.scale) / span));
+  var row1 = Math.min(Math.ceil(info.height / span),
+                      Math.ceil((this.y + height / this.scale) / span));
+  var wanted = {};
+  for(var col = col0; col < col1; col++){
+    for(var row = row0; row < row1; row++){
+      var key = level+'/'+col+'_'+row;
+      wanted[key] = true;
+      var tile = this.tiles[key];
+      if(!tile){
+        tile = this.tiles[key] = $("<img>").css({position: 'absolute',
+          'image-rendering': 'pixelated', 'pointer-events': 'none'})
+          .attr('draggable', false)
+          .attr('src', this.baseurl+'/'+key+'.png?v='+info.version)
+          .appendTo(this.container);
+      }
+      var w = Math.min(span, info.width - col*span);
+      var h = Math.min(span, info.height - row*span);
+      tile.css({left: (col*span - this.x) * this.scale,
+                top: (row*span - this.y) * this.scale,
+                width: w * this.scale, height: h * this.scale});
+    }
+  }
+  for(var key in this.tiles){
+    if(!wanted[key]){
+      this.tiles[key].remove();
+      delete this.tiles[key];
+    }
+  }
+};